@@ -9,16 +9,31 @@ import select
 import struct
 import sys
 import time
-from socket import socket, SOCK_DGRAM, AF_INET
+from array import array
+from socket import socket, SOCK_DGRAM, AF_INET, inet_aton, inet_ntoa
+from typing import Iterator
 
 HOST_ID = os.path.splitext(__file__)[0].split("_")[-1]
 THIS_NODE = f"127.0.0.{HOST_ID}"
 PORT = 4300
 MY_PORT = PORT + int(HOST_ID)
-NEIGHBORS = set()
-# ROUTING_TABLE[destination] = [cost, neighbor to send it to]
-ROUTING_TABLE = {}
 TIMEOUT = 5
+MAX_MSG = 65535
+UPDATE_INTERVAL = 30      # Seconds between full table dumps to every neighbor
+UPDATE_JITTER = 0.1       # Spread of the dump interval, so routers do not fall into step
+TRIGGER_HOLD = 0.5        # Seconds changes are gathered before a triggered update goes out
+MIN_UPDATE_GAP = 1        # Fewest seconds between two updates to the same neighbor
+INFINITY = 64             # Cost of an unreachable destination, above any real path
+MAX_ENTRIES = 279         # Routes per UPDATE, keeping it under 1400 bytes
+ENTRY = struct.Struct("!IB")    # One route of an UPDATE: address, cost
+KEEPALIVE_INTERVAL = 1    # Seconds of silence towards a neighbor before an empty UPDATE goes to it
+DEAD_INTERVAL = 3.5       # Seconds without hearing from a neighbor before its link is taken down
+PROBE_INTERVAL = 5        # Seconds between keepalives to a neighbor whose link is down
+HELLO_INTERVAL = 10       # Average seconds between messages to a random destination
+ROUTE_TIMEOUT = 180       # Seconds a learned route lives without its next hop advertising it
+GC_TIMEOUT = 120          # Seconds an unreachable route is still advertised before it is deleted
+WHEEL_RESOLUTION = 0.1    # Seconds per slot of the timer wheel
+WHEEL_SLOTS = 512
 MESSAGES = [
     "Cosmic Cuttlefish",
     "Bionic Beaver",
@@ -26,57 +41,52 @@ MESSAGES = [
     "Trusty Tahr",
     "Precise Pangolin"
 ]
-# Done
-def read_file(filename: str) -> None:
-    """Read config file"""
-    with open(filename, "r") as f:
-        configStr = f.read()
 
-    routers = configStr.split("\n\n")
-    #print(routers)
-    for config in routers:
-        splitConfig = config.split("\n")
-        #print(splitConfig)
-        # If we are looking at this node's configuration...
-        if splitConfig[0] == THIS_NODE:
-            for neighborStat in splitConfig[1:]:
-                if neighborStat != "":     # Fixes issue for last router
-                    addr, cost = neighborStat.split(" ")
-                    NEIGHBORS.add(addr)
-                    ROUTING_TABLE[addr] = [int(cost), addr]
-
-    # print("Neighbors:", NEIGHBORS)
-    # print("Table:", ROUTING_TABLE)
+def timestamp() -> str:
+    return time.strftime("%H:%M:%S", time.gmtime())
 
-# Done
-def format_update_msg() -> bytearray:
-    """Format update message"""
-    # Update messages are formed as follows:
-    #   1) 0x0 in the first byte
-    #   2) next 4 bytes denote a destination address
-    #   3) next byte denotes the cost to get to the destination
-    #
-    #   repeat 2 - 3 for all items in ROUTING_TABLE
-    #
-    #   For example 127.0.0.1 of cost 10 and to 127.0.0.2 of cost 5:
-    #
-    #       0x0    0x7f 0x0 0x0 0x1   0xA    0x7f 0x0 0x0 0x2   0x5   ...
-    #       type |    127.0.0.1     | cost |     127.0.0.2    | cost  ...
+def node_port(node: str) -> int:
+    """Port a router listens on, from the last octet of its address"""
+    return PORT + int(node.split(".")[-1])
 
-    msg = bytearray()
-    msg.append(0x0)
+def addr_to_int(addr: str) -> int:
+    return struct.unpack("!I", inet_aton(addr))[0]
 
-    for dest in ROUTING_TABLE:
-        for num in dest.split("."):
-            msg.append(int(num))
+def int_to_addr(addr: int) -> str:
+    return inet_ntoa(struct.pack("!I", addr))
 
-        msg.append(ROUTING_TABLE[dest][0])
+def check_cost(cost: int) -> int:
+    """A link cost has to leave room for a path below INFINITY"""
+    if not 1 <= cost < INFINITY:
+        raise ValueError(f"Link cost {cost} outside 1..{INFINITY - 1}")
+    return cost
 
-    #print("Update Message:", msg)
-    return msg
+# Done
+def read_config(filename: str) -> dict:
+    """Read config file into {router: {neighbor: cost}}"""
+    if filename.endswith(".toml"):
+        import tomllib
+        with open(filename, "rb") as f:
+            routers = tomllib.load(f)["routers"]
+        return {router["address"]: {n["address"]: check_cost(int(n["cost"])) for n in router["neighbors"]}
+                for router in routers}
+
+    with open(filename, "r") as f:
+        configStr = f.read()
+
+    topology = {}
+    for config in configStr.split("\n\n"):
+        splitConfig = [line for line in config.split("\n") if line != ""]
+        if not splitConfig:
+            continue
+        neighbors = topology.setdefault(splitConfig[0], {})
+        for neighborStat in splitConfig[1:]:
+            addr, cost = neighborStat.split(" ")
+            neighbors[addr] = check_cost(int(cost))
+    return topology
 
 # Done
-def parse_update_msg(msg: bytes) -> list:
+def parse_update_msg(msg: bytes) -> Iterator:
     """Parse the given update message"""
     # Update messages are formatted as such:
     #   For example 127.0.0.1 of cost 10 and to 127.0.0.2 of cost 5:
@@ -84,57 +94,12 @@ def parse_update_msg(msg: bytes) -> list:
     #       0x0    0x7f 0x0 0x0 0x1   0xA    0x7f 0x0 0x0 0x2   0x5   ...
     #       type |    127.0.0.1     | cost |     127.0.0.2    | cost  ...
 
-    updateList = []
-    i = 1   # index
-    while i < len(msg) - 1:
-        # Get the next address
-        #print(msg,i)
-        addr = str(msg[i]) + "." + str(msg[i+1]) + "." + str(msg[i+2]) + "." + str(msg[i+3])
-        cost = msg[i+4]
-
-        updateList.append((cost,addr))
-        i += 5
-
-    return updateList
-
-# Done
-def update_table(msg: bytes, neigh_addr: str) -> bool:
-    """Update routing table and return 'True' if updated"""
-
-    updateList = parse_update_msg(msg)
-    # print(f"Update Message from {neigh_addr} (cost,addr):", updateList)
-    # print(f"Current Routing Table:", ROUTING_TABLE)
-
-    changed = False
-    for update in updateList:
-        cost, dest = update
-
-        # If the destination is in the ROUTING_TABLE
-        if dest in ROUTING_TABLE:
-            # If the new cost is less than the current cost
-            if cost + ROUTING_TABLE[neigh_addr][0] < ROUTING_TABLE[dest][0]:
-                # Update the ROUTING_TABLE
-                ROUTING_TABLE[dest] = [cost + ROUTING_TABLE[neigh_addr][0], neigh_addr]
-                changed = True
-
-        else:   # Add the destination to the ROUTING_TABLE
-            if dest != THIS_NODE:
-                ROUTING_TABLE[dest] = [cost + ROUTING_TABLE[neigh_addr][0], neigh_addr]
-                changed = True
-
-    #print("Updated Table:", changed)
-    return changed
-
-# Done
-def send_update(dst_node: str) -> None:
-    """Send update"""
-    sckt = socket(AF_INET, SOCK_DGRAM)
-    sckt.bind((THIS_NODE,0))
-    dst_port = PORT + int(dst_node.split(".")[-1])
-
-    msg = format_update_msg()
-    sckt.sendto(msg, (dst_node, dst_port))
+    #
+    #   Yields (address, cost) with the address as an integer; a truncated
+    #   last entry is ignored.
 
+    count = (len(msg) - 1) // ENTRY.size
+    return ENTRY.iter_unpack(memoryview(msg)[1:1 + count * ENTRY.size])
 
 # Done
 def format_hello(msg_txt: str, src_node: str, dst_node: str) -> bytearray:
@@ -152,105 +117,534 @@ def format_hello(msg_txt: str, src_node: str, dst_node: str) -> bytearray:
 
     return msg
 
+class UDPSender:
+    """Send every message from the one socket the router listens on"""
+
+    def __init__(self, sckt: socket):
+        self.sckt = sckt
+
+    def __call__(self, msg: bytes, dst_node: str) -> None:
+        self.sckt.sendto(msg, (dst_node, node_port(dst_node)))
+
+
+class TimerWheel:
+    """Hashed timing wheel: a timer goes in the slot of the tick it fires
+    after, so setting, resetting and cancelling one are O(1) and each tick
+    only looks at its own slot. Timers fire up to one tick late; a reset
+    timer is left in its old slot and skipped when that slot comes round"""
+
+    def __init__(self, now: float, resolution: float = WHEEL_RESOLUTION, slots: int = WHEEL_SLOTS):
+        self.resolution = resolution
+        self.slots = [[] for _ in range(slots)]
+        self.pending = {}    # Key -> tick it fires after
+        self.tick = int(now // resolution)    # First tick not yet expired
+
+    def __contains__(self, key) -> bool:
+        return key in self.pending
+
+    def set(self, key, deadline: float) -> None:
+        """Fire key once deadline has passed, replacing any earlier timer for it"""
+        tick = max(int(deadline // self.resolution), self.tick)
+        if self.pending.get(key) != tick:
+            self.pending[key] = tick
+            self.slots[tick % len(self.slots)].append((tick, key))
+
+    def cancel(self, key) -> None:
+        self.pending.pop(key, None)
+
+    def expire(self, now: float) -> list:
+        """Keys of the timers whose tick is over, in no particular order"""
+        expired = []
+        current = int(now // self.resolution)
+        # After a long stall every slot is visited once, not once per tick missed
+        for tick in range(self.tick, min(current, self.tick + len(self.slots))):
+            index = tick % len(self.slots)
+            keep = []
+            for entry in self.slots[index]:
+                fires, key = entry
+                if self.pending.get(key) != fires:
+                    continue    # Cancelled or reset
+                if fires < current:
+                    del self.pending[key]
+                    expired.append(key)
+                else:
+                    keep.append(entry)    # Due on a later turn of the wheel
+            self.slots[index] = keep
+        self.tick = max(self.tick, current)
+        return expired
+
+    def next_timeout(self, now: float) -> float:
+        """Seconds until the next tick, if any timer is pending"""
+        if not self.pending:
+            return float("inf")
+        return max(0, (int(now // self.resolution) + 1) * self.resolution - now)
+
+
+class RoutingTable:
+    """Routes in parallel array columns, one row per destination, with a
+    dict from destination to row; destinations are 32-bit integers and next
+    hops are indices into the router's list of neighbors"""
+
+    def __init__(self):
+        self.index = {}             # Destination -> row
+        self.addrs = array("I")     # Row -> destination
+        self.costs = array("B")     # Row -> cost
+        self.hops = array("H")      # Row -> next hop
+
+    def __len__(self) -> int:
+        return len(self.addrs)
+
+    def __contains__(self, dest: int) -> bool:
+        return dest in self.index
+
+    def get(self, dest: int):
+        """(cost, next hop) of a destination, or None"""
+        row = self.index.get(dest)
+        if row is None:
+            return None
+        return self.costs[row], self.hops[row]
+
+    def set(self, dest: int, cost: int, hop: int) -> None:
+        row = self.index.get(dest)
+        if row is None:
+            self.index[dest] = len(self.addrs)
+            self.addrs.append(dest)
+            self.costs.append(cost)
+            self.hops.append(hop)
+        else:
+            self.costs[row] = cost
+            self.hops[row] = hop
+
+    def delete(self, dest: int) -> None:
+        """Remove a destination, moving the last row into its place"""
+        row = self.index.pop(dest)
+        last = len(self.addrs) - 1
+        if row != last:
+            self.addrs[row] = self.addrs[last]
+            self.costs[row] = self.costs[last]
+            self.hops[row] = self.hops[last]
+            self.index[self.addrs[row]] = row
+        self.addrs.pop()
+        self.costs.pop()
+        self.hops.pop()
+
+
+class Router:
+    """Distance-vector router for one node, sending its messages through
+    send(msg, neighbor) so that it can run over any transport"""
+
+    def __init__(self, address: str, send, verbose: bool = True, clock=time.monotonic,
+                 update_interval: float = UPDATE_INTERVAL, trigger_hold: float = TRIGGER_HOLD,
+                 min_update_gap: float = MIN_UPDATE_GAP, keepalive_interval: float = KEEPALIVE_INTERVAL,
+                 dead_interval: float = DEAD_INTERVAL, route_timeout: float = ROUTE_TIMEOUT,
+                 gc_timeout: float = GC_TIMEOUT, probe_interval: float = PROBE_INTERVAL):
+        self.address = address
+        self.addr_int = addr_to_int(address)
+        self.links = {}         # Neighbor -> cost of the link to it
+        self.neighbors = set()  # Neighbors whose link is up
+        self.hop_addrs = []     # Next hop index -> neighbor
+        self.hop_ints = []      # Next hop index -> neighbor as an integer
+        self.hop_index = {}     # Neighbor -> next hop index
+        self.hop_of = {}        # Neighbor as an integer -> next hop index
+        self.table = RoutingTable()
+        self.send = send
+        self.verbose = verbose
+        self.changes = 0
+
+        # Update scheduling
+        self.clock = clock
+        self.update_interval = update_interval
+        self.trigger_hold = trigger_hold
+        self.min_update_gap = min_update_gap
+        self.next_dump = 0
+        self.last_sent = {}     # Neighbor -> when it was last sent an update
+        self.owed = {}          # Neighbor -> when its pending update may go out
+        self.owed_full = set()  # Neighbors whose pending update is the whole table
+        self.dirty = {}         # Neighbor -> destinations changed since its last update
+        self.unreachable = {}   # Neighbor -> destinations it last advertised as INFINITY
+
+        # Liveness and route expiry, keyed ("alive" | "keepalive", neighbor)
+        # and ("route" | "gc", destination)
+        self.keepalive_interval = keepalive_interval
+        self.probe_interval = probe_interval
+        self.dead_interval = dead_interval
+        self.route_timeout = route_timeout
+        self.gc_timeout = gc_timeout
+        self.timers = TimerWheel(clock())
+        self.next_hello = clock() + random.expovariate(1 / HELLO_INTERVAL)
+
+    def configure(self, neighbors: dict) -> None:
+        """Add the directly connected neighbors and their link costs"""
+        for addr, cost in neighbors.items():
+            check_cost(cost)
+            self.links[addr] = cost
+            self.neighbors.add(addr)
+            self.dirty[addr] = set()
+            self.unreachable[addr] = set()
+            self.hop_index[addr] = len(self.hop_addrs)
+            self.hop_addrs.append(addr)
+            self.hop_ints.append(addr_to_int(addr))
+            self.hop_of[addr_to_int(addr)] = self.hop_index[addr]
+            self.table.set(addr_to_int(addr), cost, self.hop_index[addr])
+
+    def log(self, text: str) -> None:
+        if self.verbose:
+            print(timestamp() + " | " + text)
+
+    # Done
+    def format_update_msgs(self, neighbor: str, dests=None) -> list:
+        """Format update messages for a neighbor, carrying the given
+        destinations or the whole table"""
+        # Update messages are formed as follows:
+        #   1) 0x0 in the first byte
+        #   2) next 4 bytes denote a destination address
+        #   3) next byte denotes the cost to get to the destination
+        #
+        #   repeat 2 - 3 for up to MAX_ENTRIES destinations
+        #
+        #   For example 127.0.0.1 of cost 10 and to 127.0.0.2 of cost 5:
+        #
+        #       0x0    0x7f 0x0 0x0 0x1   0xA    0x7f 0x0 0x0 0x2   0x5   ...
+        #       type |    127.0.0.1     | cost |     127.0.0.2    | cost  ...
+        #
+        #   Routes through the neighbor itself go back to it as INFINITY
+        #   (split horizon with poison reverse), so it never routes through us
+        #   to reach them.
+
+        table = self.table
+        hop = self.hop_index[neighbor]
+        if dests is None:
+            rows = range(len(table))
+        else:
+            rows = [table.index[dest] for dest in dests]
+
+        msgs = []
+        for first in range(0, len(rows), MAX_ENTRIES):
+            chunk = rows[first:first + MAX_ENTRIES]
+            msg = bytearray(1 + len(chunk) * ENTRY.size)    # Type 0x0 already in place
+            offset = 1
+            for row in chunk:
+                ENTRY.pack_into(msg, offset, table.addrs[row],
+                                INFINITY if table.hops[row] == hop else table.costs[row])
+                offset += ENTRY.size
+            msgs.append(msg)
+        return msgs
+
+    def set_route(self, dest: int, cost: int, hop: int) -> None:
+        """Change a route and flag it for the next update to every neighbor"""
+        direct = self.hop_of.get(dest)
+        if direct is not None and self.hop_addrs[direct] in self.neighbors:
+            # A neighbor is never further away than its own link
+            link = self.links[self.hop_addrs[direct]]
+            if link < cost:
+                cost, hop = link, direct
+        self.table.set(dest, cost, hop)
+        self.refresh_route(dest)
+        for dirty in self.dirty.values():
+            dirty.add(dest)
+
+    def refresh_route(self, dest: int) -> None:
+        """Restart the timer of a route: expiry while it is reachable through
+        another router, deletion once it is unreachable"""
+        cost, hop = self.table.get(dest)
+        if cost >= INFINITY:
+            self.timers.cancel(("route", dest))
+            if ("gc", dest) not in self.timers:
+                self.timers.set(("gc", dest), self.clock() + self.gc_timeout)
+        else:
+            self.timers.cancel(("gc", dest))
+            if self.hop_ints[hop] == dest:
+                # Direct routes live as long as the link does
+                self.timers.cancel(("route", dest))
+            else:
+                self.timers.set(("route", dest), self.clock() + self.route_timeout)
+
+    # Done
+    def update_table(self, msg: bytes, neigh_addr: str) -> bool:
+        """Update routing table and return 'True' if updated"""
+        link = self.links[neigh_addr]
+        hop = self.hop_index[neigh_addr]
+        index, costs, hops = self.table.index, self.table.costs, self.table.hops
+        expires = self.clock() + self.route_timeout
+        unreachable = self.unreachable[neigh_addr]
+
+        changed = False
+        for dest, cost in parse_update_msg(msg):
+            if dest == self.addr_int:
+                continue
+            offered, cost = cost, min(cost + link, INFINITY)
+
+            # Poison reverse repeats INFINITY in every dump; only news counts
+            if offered >= INFINITY:
+                worse = dest not in unreachable
+                unreachable.add(dest)
+            else:
+                worse = True
+                unreachable.discard(dest)
+
+            row = index.get(dest)
+            if row is None:
+                # Add the destination to the table
+                if cost < INFINITY:
+                    self.set_route(dest, cost, hop)
+                    changed = True
+
+            elif hops[row] == hop:
+                # Our next hop knows best, even when the cost went up
+                if cost != costs[row]:
+                    self.set_route(dest, cost, hop)
+                    changed = True
+                elif cost < INFINITY:
+                    # Unchanged, and a neighbor never advertises itself, so
+                    # only the expiry timer needs restarting
+                    self.timers.set(("route", dest), expires)
+
+            elif cost < costs[row]:
+                # A cheaper path through this neighbor
+                self.set_route(dest, cost, hop)
+                changed = True
 
-# Done
-def parse_hello(msg: bytes, neigh_addr: str) -> str:
-    """Calculate the appropriate next hop"""
-    shouldForward = True
-
-    sender = str(msg[1]) + "." + str(msg[2]) + "." + str(msg[3]) + "." + str(msg[4])
-    destination = str(msg[5]) + "." + str(msg[6]) + "." + str(msg[7]) + "." + str(msg[8])
-    data = msg[9:].decode()
-
-    if destination == THIS_NODE:
-        shouldForward = False
-        print(time.strftime("%H:%M:%S", time.gmtime()) +" | "+ \
-            f"Received {data} from {sender}")
-
-    return (shouldForward, data, sender, destination)
-
-# Done
-def send_hello(msg_txt: str, src_node: str, dst_node: str) -> None:
-    """Send a message"""
-    sckt = socket(AF_INET, SOCK_DGRAM)
-    sckt.bind((THIS_NODE,0))
-
-    nxtHop = ROUTING_TABLE[dst_node][1]
-    hop_port = PORT + int(nxtHop.split(".")[-1])
-
-    msg = format_hello(msg_txt, src_node, dst_node)
-
-    print(time.strftime("%H:%M:%S", time.gmtime()) +" | "+ \
-        f"Sending {msg_txt} to {dst_node} via {nxtHop}")
-
-    sckt.sendto(msg,(nxtHop,hop_port))
-
-
-# Done
-def print_status() -> None:
-    """Print status of the routing table"""
+            elif worse and offered > costs[row] + link and costs[row] < INFINITY:
+                # The neighbor lost or worsened a route ours beats, so offer it
+                self.dirty[neigh_addr].add(dest)
+
+        if changed:
+            self.changes += 1
+        return changed
+
+    def link_down(self, neighbor: str) -> None:
+        """Stop using a neighbor and make every route through it unreachable"""
+        if neighbor not in self.neighbors:
+            return
+        self.neighbors.discard(neighbor)
+        self.timers.cancel(("alive", neighbor))
+        # Keep probing, more slowly, so that the neighbor hears from us and
+        # brings the link back up once traffic flows again
+        self.timers.set(("keepalive", neighbor), self.clock() + self.probe_interval)
+        self.owed.pop(neighbor, None)
+        self.owed_full.discard(neighbor)
+        self.dirty.pop(neighbor, None)
+        self.unreachable.pop(neighbor, None)
+        hop = self.hop_index[neighbor]
+        table = self.table
+        for dest, cost, nxtHop in list(zip(table.addrs, table.costs, table.hops)):
+            if nxtHop == hop and cost < INFINITY:
+                self.set_route(dest, INFINITY, hop)
+        self.changes += 1
+        self.schedule_updates(self.clock(), 0)
+
+    def link_up(self, neighbor: str) -> None:
+        """Start using a neighbor again and send it the whole table"""
+        if neighbor in self.neighbors or neighbor not in self.links:
+            return
+        self.neighbors.add(neighbor)
+        self.dirty[neighbor] = set()
+        self.unreachable[neighbor] = set()
+        now = self.clock()
+        hop = self.hop_index[neighbor]
+        dest = self.hop_ints[hop]
+        route = self.table.get(dest)
+        if route is None or route[1] == hop or self.links[neighbor] < route[0]:
+            self.set_route(dest, self.links[neighbor], hop)
+            self.changes += 1
+            self.schedule_updates(now, self.trigger_hold)
+        self.schedule_updates(now, 0, full=True, neighbors=[neighbor])
+
+    def schedule_updates(self, now: float, delay: float, full: bool = False, neighbors=None) -> None:
+        """Owe every neighbor (or just the given ones) an update, sent no sooner
+        than delay from now and no sooner than min_update_gap after the last
+        one; updates already owed are left alone, so changes arriving
+        meanwhile ride along"""
+        for neighbor in self.neighbors if neighbors is None else neighbors:
+            if full:
+                self.owed_full.add(neighbor)
+            if neighbor not in self.owed:
+                self.owed[neighbor] = max(now + delay, self.last_sent.get(neighbor, float("-inf")) + self.min_update_gap)
+
+    def send_due_updates(self, now: float) -> None:
+        """Send the periodic dump when it is time, and any owed updates now due:
+        the whole table, or only the routes changed since that neighbor's last
+        update"""
+        if now >= self.next_dump:
+            self.schedule_updates(now, 0, full=True)
+            self.next_dump = now + self.update_interval * random.uniform(1 - UPDATE_JITTER, 1 + UPDATE_JITTER)
+        due = [neighbor for neighbor, when in self.owed.items() if when <= now]
+        for neighbor in due:
+            del self.owed[neighbor]
+            dests = self.dirty[neighbor]
+            self.dirty[neighbor] = set()
+            if neighbor in self.owed_full:
+                self.owed_full.discard(neighbor)
+                dests = None
+            elif not dests:
+                continue
+            self.last_sent[neighbor] = now
+            self.timers.set(("keepalive", neighbor), now + self.keepalive_interval)
+            for msg in self.format_update_msgs(neighbor, dests):
+                self.send(msg, neighbor)
+
+    def expire_timers(self, now: float) -> None:
+        """Act on the liveness and route timers that have run out"""
+        changed = False
+        for kind, key in self.timers.expire(now):
+            if kind == "alive":
+                self.log(f"Nothing heard from {key} for {self.dead_interval} s, taking the link down")
+                self.link_down(key)
+
+            elif kind == "keepalive":
+                # An UPDATE without routes: old routers parse it to nothing
+                self.send(bytearray([0x0]), key)
+                interval = self.keepalive_interval if key in self.neighbors else self.probe_interval
+                self.timers.set(("keepalive", key), now + interval)
+
+            elif kind == "route":
+                cost, hop = self.table.get(key)
+                self.log(f"Route to {int_to_addr(key)} via {self.hop_addrs[hop]} timed out")
+                self.set_route(key, INFINITY, hop)
+                changed = True
 
-    print("     {:^14} {:^10} {:^14}".format("Host","Cost","Via"))
-    for router in ROUTING_TABLE:
-        print("     {:^14} {:^10} {:^14}".format(router,ROUTING_TABLE[router][0],ROUTING_TABLE[router][1]))
+            elif kind == "gc":
+                self.table.delete(key)
+                for dirty in self.dirty.values():
+                    dirty.discard(key)
+                for unreachable in self.unreachable.values():
+                    unreachable.discard(key)
+
+        if changed:
+            self.changes += 1
+            self.schedule_updates(now, self.trigger_hold)
+
+    def next_timeout(self, now: float) -> float:
+        """Seconds until an update or a timer is due"""
+        return min(max(0, min([self.next_dump] + list(self.owed.values())) - now),
+                   self.timers.next_timeout(now))
+
+    def routes(self) -> dict:
+        """Cost of every reachable destination"""
+        table = self.table
+        return {int_to_addr(dest): cost for dest, cost in zip(table.addrs, table.costs) if cost < INFINITY}
+
+    # Done
+    def parse_hello(self, msg: bytes, neigh_addr: str) -> tuple:
+        """Calculate the appropriate next hop"""
+        shouldForward = True
+
+        sender = str(msg[1]) + "." + str(msg[2]) + "." + str(msg[3]) + "." + str(msg[4])
+        destination = str(msg[5]) + "." + str(msg[6]) + "." + str(msg[7]) + "." + str(msg[8])
+        data = msg[9:].decode()
+
+        if destination == self.address:
+            shouldForward = False
+            self.log(f"Received {data} from {sender}")
+
+        return (shouldForward, data, sender, destination)
+
+    # Done
+    def send_hello(self, msg_txt: str, src_node: str, dst_node: str) -> None:
+        """Send a message"""
+        route = self.table.get(addr_to_int(dst_node))
+        if route is None or route[0] >= INFINITY:
+            self.log(f"No route to {dst_node}, dropping {msg_txt}")
+            return
+        nxtHop = self.hop_addrs[route[1]]
+
+        msg = format_hello(msg_txt, src_node, dst_node)
+
+        self.log(f"Sending {msg_txt} to {dst_node} via {nxtHop}")
+
+        self.send(msg, nxtHop)
+
+    # Done
+    def print_status(self) -> None:
+        """Print status of the routing table"""
+
+        print("     {:^14} {:^10} {:^14}".format("Host","Cost","Via"))
+        for dest, cost, hop in zip(self.table.addrs, self.table.costs, self.table.hops):
+            print("     {:^14} {:^10} {:^14}".format(int_to_addr(dest),cost,self.hop_addrs[hop]))
+
+    def start(self) -> None:
+        """Announce ourselves to the neighbors, and expect to hear from them"""
+        if self.verbose:
+            self.print_status()
+        now = self.clock()
+        for neighbor in self.neighbors:
+            self.timers.set(("alive", neighbor), now + self.dead_interval)
+        self.send_due_updates(now)
+
+    def tick(self, chatty: bool = True) -> None:
+        """Once per pass of the main loop: run the timers that are due, send
+        the updates that are due and now and then a message to a random
+        destination, every HELLO_INTERVAL on average"""
+        now = self.clock()
+        if now >= self.next_hello:
+            self.next_hello = now + random.expovariate(1 / HELLO_INTERVAL)
+            if chatty and self.table:
+                msg = random.choice(MESSAGES)
+                dst = int_to_addr(random.choice(self.table.addrs))
+
+                self.send_hello(msg,self.address,dst)
+
+        self.expire_timers(now)
+        self.send_due_updates(now)
+
+    def handle(self, msg: bytes, src_node: str) -> None:
+        """Process a message received from a neighbor"""
+        if not msg or src_node not in self.links:
+            return
+
+        self.timers.set(("alive", src_node), self.clock() + self.dead_interval)
+        if src_node not in self.neighbors:
+            self.log(f"Heard from {src_node} again, bringing the link up")
+            self.link_up(src_node)
+
+        if msg[0] == 1:
+            # We have a hello_message
+            shouldForward, decoded_msg, sender, dest = self.parse_hello(msg, src_node)
+
+            if shouldForward:
+                self.send_hello(decoded_msg, sender, dest)
+
+        elif msg[0] == 0:
+            # We have an update_message
+            if self.update_table(msg, src_node):
+                self.log("Updated table with information from {}".format(src_node))
+                if self.verbose:
+                    self.print_status()
+                self.schedule_updates(self.clock(), self.trigger_hold)
+            elif self.dirty[src_node]:
+                self.schedule_updates(self.clock(), self.trigger_hold, neighbors=[src_node])
+
+        # If the flag is not 0 or 1, then we should drop the packet.
 
 
 def main(args: list):
     """Router main loop"""
+    my_listener = socket(AF_INET, SOCK_DGRAM)
+
     # Read our configuration
-    read_file(args[1])
+    router = Router(THIS_NODE, UDPSender(my_listener))
+    router.configure(read_config(args[1]).get(THIS_NODE, {}))
 
-    print(time.strftime("%H:%M:%S", time.gmtime()) +" | "+ "{} here".format(THIS_NODE))
+    router.log("{} here".format(THIS_NODE))
 
-    my_listener = socket(AF_INET, SOCK_DGRAM)
     my_listener.bind((THIS_NODE, MY_PORT))
-    print(time.strftime("%H:%M:%S", time.gmtime()) +" | "+ "Binding to {}:{}".format(THIS_NODE, MY_PORT))
-
-    print_status()
+    router.log("Binding to {}:{}".format(THIS_NODE, MY_PORT))
 
-    for neighbor in NEIGHBORS:
-        send_update(neighbor)
+    router.start()
 
     while True:
         # The following decides when to "randomly" send messages
         #  to other nodes.
-
-        rand = random.randrange(0,10)
-        if rand == 5:
-            msg = random.choice(MESSAGES)
-            dst = random.choice(list(ROUTING_TABLE.keys()))
-
-            send_hello(msg,THIS_NODE,dst)
-
-        elif rand == 1:
-            for neighbor in NEIGHBORS:
-                send_update(neighbor)
+        router.tick()
 
         # Processing Loop
 
-        what_ready = select.select([my_listener], [], [], TIMEOUT)
+        wait = min(TIMEOUT, router.next_timeout(router.clock()))
+        what_ready = select.select([my_listener], [], [], wait)
 
         for sckt in what_ready[0]:
-            msg, addr = sckt.recvfrom(1024)
-
-            if msg[0] == 1:
-                # We have a hello_message
-                shouldForward, decoded_msg, sender, dest = parse_hello(msg, addr[0])
-
-                if shouldForward:
-                    send_hello(decoded_msg, sender, dest)
-
-            elif msg[0] == 0:
-                # We have an update_message
-                updated = update_table(msg, addr[0])
-
-                if updated:
-                    print(time.strftime("%H:%M:%S", time.gmtime()) +" | "+ "Updated table with information from {}".format(addr[0]))
-                    print_status()
-                    for neighbor in NEIGHBORS:
-                        send_update(neighbor)
-
-            # If the flag is not 0 or 1, then we should drop the packet.
+            msg, addr = sckt.recvfrom(MAX_MSG)
+            router.handle(msg, addr[0])
 
 if __name__ == "__main__":
     main(sys.argv)
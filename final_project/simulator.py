@@ -0,0 +1,317 @@
+"""Run many routers in one process to study convergence"""
+#!/usr/bin/env python3
+# encoding: UTF-8
+
+
+import argparse
+import asyncio
+import heapq
+import random
+import sys
+
+from router_1 import (DEAD_INTERVAL, INFINITY, KEEPALIVE_INTERVAL, MIN_UPDATE_GAP, PROBE_INTERVAL,
+                      TRIGGER_HOLD, UPDATE_INTERVAL, Router, node_port, read_config)
+
+TICK_SEC = 0.05
+CHECK_SEC = 0.5
+LATENCY_SEC = 0.001
+DURATION_SEC = 60
+DEGREE = 4
+MAX_COST = 5
+
+# Done
+def generate_topology(count: int, degree: int = DEGREE, max_cost: int = MAX_COST, seed: int = None) -> dict:
+    """Random connected topology: a random spanning tree, then extra links
+    until the average degree is reached"""
+    rng = random.Random(seed)
+    # Addresses stay inside 127/8 so the UDP transport can bind every one of them
+    nodes = [f"127.0.{i // 254}.{i % 254 + 1}" for i in range(count)]
+    topology = {node: {} for node in nodes}
+
+    def link(a: str, b: str) -> None:
+        cost = rng.randint(1, max_cost)
+        topology[a][b] = cost
+        topology[b][a] = cost
+
+    for i in range(1, count):
+        link(nodes[i], nodes[rng.randrange(i)])
+    links = count - 1
+    target = min(count * degree // 2, count * (count - 1) // 2)
+    while links < target:
+        a, b = rng.sample(nodes, 2)
+        if b not in topology[a]:
+            link(a, b)
+            links += 1
+    return topology
+
+# Done
+def fail_links(topology: dict, count: int, seed: int = None) -> list:
+    """Remove count random links from the topology and return them as
+    (a, b, cost)"""
+    rng = random.Random(seed)
+    links = sorted((a, b, cost) for a in topology for b, cost in topology[a].items() if a < b)
+    failed = rng.sample(links, min(count, len(links)))
+    for a, b, _ in failed:
+        del topology[a][b]
+        del topology[b][a]
+    return failed
+
+# Done
+def restore_links(topology: dict, links: list) -> None:
+    """Put links taken out by fail_links back into the topology"""
+    for a, b, cost in links:
+        topology[a][b] = cost
+        topology[b][a] = cost
+
+# Done
+def shortest_paths(topology: dict, source: str) -> dict:
+    """Dijkstra's costs from one router to every other it can reach below
+    INFINITY, which is as far as distance vector routing can see"""
+    costs = {source: 0}
+    heap = [(0, source)]
+    while heap:
+        cost, node = heapq.heappop(heap)
+        if cost > costs[node]:
+            continue
+        for neighbor, link_cost in topology[node].items():
+            if cost + link_cost < costs.get(neighbor, float("inf")):
+                costs[neighbor] = cost + link_cost
+                heapq.heappush(heap, (cost + link_cost, neighbor))
+    return {node: cost for node, cost in costs.items() if node != source and cost < INFINITY}
+
+
+class MemoryNetwork:
+    """Deliver messages between routers through the event loop"""
+
+    def __init__(self, latency: float = LATENCY_SEC):
+        self.latency = latency
+        self.routers = {}
+        self.messages = 0
+        self.bytes = 0
+        self.deadline = float("inf")   # Messages sent after it are dropped, ending the run
+        self.down = set()              # (src, dst) pairs whose messages are dropped
+
+    async def open(self, routers: dict) -> None:
+        self.routers = routers
+
+    def sender(self, src_node: str):
+        loop = asyncio.get_running_loop()
+
+        def send(msg: bytes, dst_node: str) -> None:
+            if loop.time() > self.deadline or (src_node, dst_node) in self.down:
+                return
+            self.messages += 1
+            self.bytes += len(msg)
+            router = self.routers.get(dst_node)
+            if router is not None:
+                loop.call_later(self.latency, self.deliver, loop, router, bytes(msg), src_node)
+        return send
+
+    def deliver(self, loop, router: Router, msg: bytes, src_node: str) -> None:
+        if loop.time() <= self.deadline:
+            router.handle(msg, src_node)
+
+    def close(self) -> None:
+        pass
+
+
+class RouterProtocol(asyncio.DatagramProtocol):
+    """Hand the datagrams of one loopback address to its router"""
+
+    def __init__(self, router: Router):
+        self.router = router
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        self.router.handle(data, addr[0])
+
+
+class UDPNetwork(MemoryNetwork):
+    """Give every router its own datagram endpoint on its loopback address"""
+
+    def __init__(self):
+        super().__init__(0)
+        self.transports = {}
+
+    async def open(self, routers: dict) -> None:
+        loop = asyncio.get_running_loop()
+        self.routers = routers
+        for addr, router in routers.items():
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda router=router: RouterProtocol(router), local_addr=(addr, node_port(addr)))
+            self.transports[addr] = transport
+
+    def sender(self, src_node: str):
+        loop = asyncio.get_running_loop()
+
+        def send(msg: bytes, dst_node: str) -> None:
+            if loop.time() > self.deadline or (src_node, dst_node) in self.down:
+                return
+            self.messages += 1
+            self.bytes += len(msg)
+            self.transports[src_node].sendto(msg, (dst_node, node_port(dst_node)))
+        return send
+
+    def close(self) -> None:
+        for transport in self.transports.values():
+            transport.close()
+
+
+def converged(routers: dict, expected: dict) -> bool:
+    """Whether every router has the shortest path cost to every destination
+    it can reach, and no route to any it cannot"""
+    for addr, router in routers.items():
+        if router.routes() != expected[addr]:
+            return False
+    return True
+
+# Done
+async def run_until_converged(routers: dict, topology: dict, network: MemoryNetwork, duration: float,
+                              tick_sec: float, chatty: bool):
+    """Tick the routers until their tables agree with the shortest paths of
+    the topology; return how long that took, or None if the duration ran out"""
+    loop = asyncio.get_running_loop()
+    expected = {addr: shortest_paths(topology, addr) for addr in topology}
+    start = loop.time()
+    network.deadline = start + duration
+    next_check = start
+    while loop.time() - start < duration:
+        for router in routers.values():
+            router.tick(chatty)
+        await asyncio.sleep(tick_sec)
+        if loop.time() >= next_check:
+            next_check = loop.time() + CHECK_SEC
+            if converged(routers, expected):
+                return loop.time() - start
+    return None
+
+# Done
+async def simulate(topology: dict, network: MemoryNetwork, duration: float = DURATION_SEC,
+                   tick_sec: float = TICK_SEC, chatty: bool = False, fail: int = 0,
+                   seed: int = None, **timers) -> dict:
+    """Run a router per node of the topology until their tables agree with
+    the shortest paths, or the duration runs out; then cut fail random links,
+    which the routers have to notice by themselves, and do it again; then
+    restore them, which the routers have to notice too, and do it once more;
+    timers are passed on to the routers"""
+    loop = asyncio.get_running_loop()
+    routers = {addr: Router(addr, network.sender(addr), verbose=False, clock=loop.time, **timers)
+               for addr in topology}
+    for addr, router in routers.items():
+        router.configure(topology[addr])
+    await network.open(routers)
+
+    for router in routers.values():
+        router.start()
+    results = {
+        'routers': len(routers),
+        'links': sum(len(neighbors) for neighbors in topology.values()) // 2,
+        'convergence': await run_until_converged(routers, topology, network, duration, tick_sec, chatty),
+        'messages': network.messages,
+        'bytes': network.bytes,
+        'changes': sum(router.changes for router in routers.values()),
+    }
+
+    if fail and results['convergence'] is not None:
+        failed = fail_links(topology, fail, seed)
+        for a, b, _ in failed:
+            network.down.update(((a, b), (b, a)))
+        results.update({
+            'failed': len(failed),
+            'reconvergence': await run_until_converged(routers, topology, network, duration, tick_sec, chatty),
+            'fail_messages': network.messages - results['messages'],
+            'fail_bytes': network.bytes - results['bytes'],
+            'fail_changes': sum(router.changes for router in routers.values()) - results['changes'],
+        })
+
+        messages, sent, changes = network.messages, network.bytes, sum(router.changes for router in routers.values())
+        restore_links(topology, failed)
+        network.down.clear()
+        results.update({
+            'restoration': await run_until_converged(routers, topology, network, duration, tick_sec, chatty),
+            'restore_messages': network.messages - messages,
+            'restore_bytes': network.bytes - sent,
+            'restore_changes': sum(router.changes for router in routers.values()) - changes,
+        })
+    network.close()
+    return results
+
+# Done
+def print_report(results: dict) -> None:
+    """Print the size of the network and how it converged"""
+    print("Routers:     {}".format(results['routers']))
+    print("Links:       {}".format(results['links']))
+    if results['convergence'] is None:
+        print("Converged:   no")
+    else:
+        print("Converged:   {:.2f} s".format(results['convergence']))
+    print("Messages:    {}".format(results['messages']))
+    print("Bytes:       {}".format(results['bytes']))
+    print("Changes:     {}".format(results['changes']))
+    if 'failed' in results:
+        print("Failed:      {} links".format(results['failed']))
+        if results['reconvergence'] is None:
+            print("Reconverged: no")
+        else:
+            print("Reconverged: {:.2f} s".format(results['reconvergence']))
+        print("Messages:    {}".format(results['fail_messages']))
+        print("Bytes:       {}".format(results['fail_bytes']))
+        print("Changes:     {}".format(results['fail_changes']))
+        print("Restored:    {} links".format(results['failed']))
+        if results['restoration'] is None:
+            print("Reconverged: no")
+        else:
+            print("Reconverged: {:.2f} s".format(results['restoration']))
+        print("Messages:    {}".format(results['restore_messages']))
+        print("Bytes:       {}".format(results['restore_bytes']))
+        print("Changes:     {}".format(results['restore_changes']))
+
+
+def main(args: list):
+    """Simulator main function"""
+    parser = argparse.ArgumentParser(prog="simulator.py", description="Distance-vector network simulator")
+    parser.add_argument("config", nargs="?", help="network config file (.txt or .toml)")
+    parser.add_argument("--generate", type=int, metavar="N", help="use a random topology of N routers instead")
+    parser.add_argument("--degree", type=int, default=DEGREE, help="average links per generated router")
+    parser.add_argument("--max-cost", type=int, default=MAX_COST, help="highest generated link cost")
+    parser.add_argument("--seed", type=int, help="seed for the generated topology")
+    parser.add_argument("--udp", action="store_true", help="send over loopback sockets instead of in memory")
+    parser.add_argument("--latency", type=float, default=LATENCY_SEC, help="in-memory link delay in seconds")
+    parser.add_argument("--tick", type=float, default=TICK_SEC, help="seconds between router ticks")
+    parser.add_argument("--interval", type=float, default=UPDATE_INTERVAL, help="seconds between full table dumps")
+    parser.add_argument("--hold", type=float, default=TRIGGER_HOLD,
+                        help="seconds changes are gathered before a triggered update")
+    parser.add_argument("--min-gap", type=float, default=MIN_UPDATE_GAP,
+                        help="fewest seconds between updates to one neighbor")
+    parser.add_argument("--keepalive", type=float, default=KEEPALIVE_INTERVAL,
+                        help="seconds of silence before a keepalive goes to a neighbor")
+    parser.add_argument("--dead", type=float, default=DEAD_INTERVAL,
+                        help="seconds without hearing from a neighbor before its link goes down")
+    parser.add_argument("--probe", type=float, default=PROBE_INTERVAL,
+                        help="seconds between keepalives to a neighbor whose link is down")
+    parser.add_argument("--hello", action="store_true", help="let routers send each other messages")
+    parser.add_argument("--fail", type=int, default=0, metavar="K",
+                        help="after converging, take down K random links, converge again, then bring them back")
+    parser.add_argument("--duration", type=float, default=DURATION_SEC, help="give up after this many seconds")
+    opts = parser.parse_args(args[1:])
+
+    if not 1 <= opts.max_cost < INFINITY:
+        parser.error(f"--max-cost must be between 1 and {INFINITY - 1}")
+    if opts.generate:
+        topology = generate_topology(opts.generate, opts.degree, opts.max_cost, opts.seed)
+    elif opts.config:
+        try:
+            topology = read_config(opts.config)
+        except ValueError as err:
+            parser.error(str(err))
+    else:
+        parser.error("give a config file or --generate")
+
+    network = UDPNetwork() if opts.udp else MemoryNetwork(opts.latency)
+    results = asyncio.run(simulate(topology, network, opts.duration, opts.tick, opts.hello, opts.fail, opts.seed,
+                                   update_interval=opts.interval, trigger_hold=opts.hold,
+                                   min_update_gap=opts.min_gap, keepalive_interval=opts.keepalive,
+                                   dead_interval=opts.dead, probe_interval=opts.probe))
+    print_report(results)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,171 @@
+"""
+Testing the router's timer wheel and routing table
+"""
+#!/usr/bin/python3
+
+
+import pytest
+from router_1 import TimerWheel
+from router_1 import RoutingTable
+from router_1 import Router
+from router_1 import parse_update_msg
+from router_1 import addr_to_int
+from router_1 import INFINITY
+from router_1 import WHEEL_SLOTS
+
+
+class TestTimerWheel:
+    """Testing the hashed timer wheel"""
+
+    @pytest.fixture(scope='function', autouse=True)
+    def setup_class(self):
+        """Setting up"""
+        self.wheel = TimerWheel(0, resolution=0.1, slots=8)
+
+    def test_fires_after_its_tick(self):
+        """A timer fires once its tick is over, and only once"""
+        self.wheel.set("a", 0.25)
+        assert self.wheel.expire(0.25) == []
+        assert self.wheel.expire(0.35) == ["a"]
+        assert self.wheel.expire(0.45) == []
+        assert "a" not in self.wheel
+
+    def test_reset(self):
+        """A reset timer fires at its new deadline only"""
+        self.wheel.set("a", 0.2)
+        self.wheel.set("a", 0.5)
+        assert self.wheel.expire(0.4) == []
+        assert self.wheel.expire(0.6) == ["a"]
+
+    def test_reset_earlier(self):
+        """A timer can be moved earlier as well"""
+        self.wheel.set("a", 0.5)
+        self.wheel.set("a", 0.1)
+        assert self.wheel.expire(0.3) == ["a"]
+        assert self.wheel.expire(0.7) == []
+
+    def test_cancel(self):
+        """A cancelled timer never fires"""
+        self.wheel.set("a", 0.2)
+        self.wheel.set("b", 0.2)
+        self.wheel.cancel("a")
+        self.wheel.cancel("c")
+        assert "a" not in self.wheel
+        assert self.wheel.expire(1) == ["b"]
+
+    def test_past_deadline(self):
+        """A deadline already passed fires on the next expire"""
+        self.wheel.expire(1)
+        self.wheel.set("a", 0.5)
+        assert self.wheel.expire(1.1) == ["a"]
+
+    def test_wrap_around(self):
+        """A timer further out than one turn of the wheel waits its turn"""
+        self.wheel.set("a", 2.05)    # Slot 4 of 8, on the third turn
+        self.wheel.set("b", 0.45)    # Same slot, first turn
+        assert self.wheel.expire(0.55) == ["b"]
+        assert self.wheel.expire(1.3) == []
+        assert self.wheel.expire(2.0) == []
+        assert self.wheel.expire(2.15) == ["a"]
+
+    def test_stall(self):
+        """After a stall of many turns every due timer fires, once"""
+        for i in range(20):
+            self.wheel.set(i, i * 0.3)
+        self.wheel.set("late", 100)
+        assert sorted(self.wheel.expire(50)) == list(range(20))
+        assert self.wheel.expire(60) == []
+        assert self.wheel.expire(100.2) == ["late"]
+
+    def test_next_timeout(self):
+        """Wake for the next tick only while a timer is pending"""
+        assert self.wheel.next_timeout(0.05) == float("inf")
+        self.wheel.set("a", 10)
+        assert self.wheel.next_timeout(0.05) == pytest.approx(0.05)
+
+    def test_default_slots(self):
+        """Timers past WHEEL_SLOTS ticks still fire on time"""
+        wheel = TimerWheel(0)
+        deadline = WHEEL_SLOTS * wheel.resolution + 1
+        wheel.set("a", deadline)
+        assert wheel.expire(deadline - 1) == []
+        assert wheel.expire(deadline + wheel.resolution) == ["a"]
+
+
+class TestRoutingTable:
+    """Testing the array-backed routing table"""
+
+    @pytest.fixture(scope='function', autouse=True)
+    def setup_class(self):
+        """Setting up"""
+        self.table = RoutingTable()
+        for dest in range(1, 5):
+            self.table.set(dest, dest * 10, dest % 2)
+
+    def test_set_get(self):
+        """Add and change routes"""
+        assert len(self.table) == 4
+        assert self.table.get(3) == (30, 1)
+        assert self.table.get(9) is None
+        self.table.set(3, 7, 0)
+        assert self.table.get(3) == (7, 0)
+        assert len(self.table) == 4
+
+    def test_delete_middle(self):
+        """Deleting a row moves the last one into it and fixes the index"""
+        self.table.delete(2)
+        assert len(self.table) == 3
+        assert 2 not in self.table
+        assert self.table.index[4] == 1
+        assert list(self.table.addrs) == [1, 4, 3]
+        assert self.table.get(4) == (40, 0)
+        for dest in (1, 3, 4):
+            assert self.table.addrs[self.table.index[dest]] == dest
+
+    def test_delete_last(self):
+        """Deleting the last row moves nothing"""
+        self.table.delete(4)
+        assert list(self.table.addrs) == [1, 2, 3]
+        assert self.table.get(3) == (30, 1)
+
+    def test_delete_all(self):
+        """Rows can be deleted down to nothing and added again"""
+        for dest in (3, 1, 4, 2):
+            self.table.delete(dest)
+        assert len(self.table) == 0
+        assert self.table.index == {}
+        self.table.set(5, 1, 0)
+        assert self.table.index == {5: 0}
+
+
+class TestRouter:
+    """Testing update messages"""
+
+    @pytest.fixture(scope='function', autouse=True)
+    def setup_class(self):
+        """Setting up"""
+        self.now = 0.0
+        self.router = Router("10.0.0.1", lambda msg, dst: None, verbose=False, clock=lambda: self.now)
+        self.router.configure({"10.0.0.2": 1, "10.0.0.3": 2})
+
+    def test_round_trip(self):
+        """Learned routes go out with their costs, and poisoned to their next hop"""
+        msg = bytes([0, 10, 0, 0, 9, 3, 10, 0, 0, 8, 5])
+        assert self.router.update_table(msg, "10.0.0.2")
+        assert self.router.routes()["10.0.0.9"] == 4
+        sent = dict(parse_update_msg(self.router.format_update_msgs("10.0.0.3")[0]))
+        assert sent[addr_to_int("10.0.0.9")] == 4
+        sent = dict(parse_update_msg(self.router.format_update_msgs("10.0.0.2")[0]))
+        assert sent[addr_to_int("10.0.0.9")] == INFINITY
+
+    def test_link_costs(self):
+        """Link costs must leave room for a path below INFINITY"""
+        for cost in (0, INFINITY, 300):
+            with pytest.raises(ValueError):
+                self.router.configure({"10.0.0.4": cost})
+        self.router.configure({"10.0.0.4": INFINITY - 1})
+        assert self.router.routes()["10.0.0.4"] == INFINITY - 1
+
+    def test_truncated(self):
+        """A truncated last entry is ignored"""
+        assert list(parse_update_msg(bytes([0, 10, 0, 0, 9, 3, 10, 0]))) == [(addr_to_int("10.0.0.9"), 3)]
@@ -0,0 +1,180 @@
+'''
+DNS load generator and latency benchmark
+'''
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import os
+import random
+import struct
+import subprocess
+import sys
+import time
+
+from nameserver import HOST, PORT, HEADER, QUESTION, qualify, read_zone_file
+
+
+QPS = 1000
+DURATION_SEC = 10
+INFLIGHT = 256
+AAAA_RATIO = 0.3
+MISS_RATE = 0.05
+TIMEOUT_SEC = 2
+
+# Done
+def build_query_mix(filenames: list, aaaa_ratio: float, miss_rate: float, size: int = 10000) -> list:
+    '''Draw (name, type) pairs from the owner names of the zone files'''
+    names = []
+    origins = []
+    for filename in filenames:
+        origin, zone = read_zone_file(filename)
+        origins.append(origin)
+        names.extend(qualify(name, origin) for name in zone)
+
+    mix = []
+    for _ in range(size):
+        if random.random() < miss_rate:
+            name = "miss{}.{}".format(random.randrange(1000000), random.choice(origins))
+        else:
+            name = random.choice(names)
+        mix.append((name, 28 if random.random() < aaaa_ratio else 1))
+    return mix
+
+# Done
+def format_query(trans_id: int, name: str, qry_type: int) -> bytes:
+    '''Format a query with recursion desired'''
+    qname = b"".join(bytes([len(label)]) + label.encode() for label in name.split(".")) + b"\x00"
+    return HEADER.pack(trans_id, 0x0100, 1, 0, 0, 0) + qname + QUESTION.pack(qry_type, 1)
+
+# Done
+def percentile(sorted_vals: list, pct: float) -> float:
+    '''Nearest-rank percentile of an already sorted list'''
+    if not sorted_vals:
+        return float("nan")
+    return sorted_vals[min(len(sorted_vals) - 1, int(len(sorted_vals) * pct / 100))]
+
+
+class LoadClient(asyncio.DatagramProtocol):
+    '''Keep track of the queries in flight and their latency'''
+
+    def __init__(self):
+        self.transport = None
+        self.pending = dict()           # Transaction ID -> send time
+        self.latencies = []
+        self.rcodes = dict()
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        sent = self.pending.pop(struct.unpack_from("!H", data)[0], None)
+        if sent is not None:
+            self.latencies.append(time.perf_counter() - sent)
+            rcode = data[3] & 0x0f
+            self.rcodes[rcode] = self.rcodes.get(rcode, 0) + 1
+
+    def expire(self, timeout_sec: float) -> int:
+        '''Forget queries older than the timeout, return how many'''
+        cutoff = time.perf_counter() - timeout_sec
+        expired = [trans_id for trans_id, sent in self.pending.items() if sent < cutoff]
+        for trans_id in expired:
+            del self.pending[trans_id]
+        return len(expired)
+
+# Done
+async def run_load(mix: list, host: str, port: int, qps: int, duration: float,
+                   inflight: int, timeout_sec: float) -> dict:
+    '''Send queries at the target rate and collect the results'''
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(LoadClient, remote_addr=(host, port))
+
+    slots = 0
+    sent = 0
+    lost = 0
+    throttled = 0
+    trans_id = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        due = int((time.perf_counter() - start) * qps)
+        while slots < due:
+            slots += 1
+            if len(client.pending) >= inflight:     # Too many outstanding, skip this slot
+                throttled += 1
+                continue
+            trans_id = (trans_id + 1) & 0xffff
+            while trans_id in client.pending:
+                trans_id = (trans_id + 1) & 0xffff
+            name, qry_type = mix[sent % len(mix)]
+            client.pending[trans_id] = time.perf_counter()
+            transport.sendto(format_query(trans_id, name, qry_type))
+            sent += 1
+        lost += client.expire(timeout_sec)
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    while client.pending and time.perf_counter() - start < duration + timeout_sec:
+        await asyncio.sleep(0.01)
+    lost += len(client.pending)
+    transport.close()
+
+    latencies = sorted(client.latencies)
+    return {
+        'sent': sent,
+        'received': len(latencies),
+        'lost': lost,
+        'throttled': throttled,
+        'qps': len(latencies) / elapsed,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'p999': percentile(latencies, 99.9),
+        'rcodes': client.rcodes,
+    }
+
+# Done
+def print_report(results: dict) -> None:
+    '''Print throughput, latency and loss'''
+    print("Sent:       {}".format(results['sent']))
+    print("Received:   {}".format(results['received']))
+    print("Lost:       {} ({:.2%})".format(results['lost'], results['lost'] / max(results['sent'], 1)))
+    print("Throttled:  {}".format(results['throttled']))
+    print("Throughput: {:.0f} queries/s".format(results['qps']))
+    print("Latency:    p50 {:.3f} ms, p99 {:.3f} ms, p99.9 {:.3f} ms".format(
+        results['p50'] * 1000, results['p99'] * 1000, results['p999'] * 1000))
+    print("Rcodes:     {}".format(", ".join("{}: {}".format(k, v) for k, v in sorted(results['rcodes'].items()))))
+
+# Done
+def main(*argv):
+    '''Main function'''
+    parser = argparse.ArgumentParser(prog='dnsperf.py', description='DNS load generator')
+    parser.add_argument('zone_files', nargs='+', metavar='zone_file', help='zone files to draw names from')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--qps', type=int, default=QPS, help='target queries per second')
+    parser.add_argument('--duration', type=float, default=DURATION_SEC, help='seconds to send for')
+    parser.add_argument('--inflight', type=int, default=INFLIGHT, help='most queries awaiting an answer')
+    parser.add_argument('--aaaa-ratio', type=float, default=AAAA_RATIO, help='share of AAAA queries')
+    parser.add_argument('--miss-rate', type=float, default=MISS_RATE, help='share of names not in the zone')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT_SEC, help='seconds before a query is lost')
+    parser.add_argument('--spawn', nargs=argparse.REMAINDER, metavar='ARG',
+                        help='start nameserver.py on the zone files with these extra arguments')
+    args = parser.parse_args(argv[0][1:])
+
+    server = None
+    if args.spawn is not None:
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nameserver.py')] + args.zone_files + args.spawn)
+        time.sleep(1)
+
+    try:
+        mix = build_query_mix(args.zone_files, args.aaaa_ratio, args.miss_rate)
+        results = asyncio.run(run_load(mix, args.host, args.port, args.qps, args.duration,
+                                       args.inflight, args.timeout))
+        print_report(results)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
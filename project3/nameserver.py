@@ -3,13 +3,38 @@ DNS Name Server
 '''
 #!/usr/bin/env python3
 
+import argparse
+import asyncio
+import mmap
+import os
+import re
+import signal
+import struct
 import sys
+import time
+import zlib
 from random import randint, choice
-from socket import socket, SOCK_DGRAM, AF_INET
+from select import select
+from socket import socket, inet_pton, timeout, SOCK_DGRAM, SOCK_STREAM, AF_INET, AF_INET6, SOL_SOCKET, SO_REUSEADDR, SO_REUSEPORT
+from queue import SimpleQueue
+from threading import Event, Thread
+from time import perf_counter_ns
 
 
 HOST = "localhost"
 PORT = 43053
+WORKERS = 1
+BATCH_SIZE = 1
+UDP_SIZE = 512
+POLL_SEC = 0.5
+TCP_BACKLOG = 128
+TCP_IDLE_SEC = 10
+TCP_MAX_BUFFER = 65536 * 4
+RELOAD_SEC = 2
+LOG_RATE = 10
+STAGES = ('parse', 'lookup', 'format', 'send')
+# CHAOS class TXT names answered with the worker's statistics
+STATS_NAMES = ('stats.server',)
 
 DNS_TYPES = {
     1: 'A',
@@ -22,14 +47,48 @@ DNS_TYPES = {
 }
 
 TTL_SEC = {
-    '1s': 1,
-    '1m': 60,
-    '1h': 60*60,
-    '1d': 60*60*24,
-    '1w': 60*60*24*7,
-    '1y': 60*60*24*365
+    's': 1,
+    'm': 60,
+    'h': 60*60,
+    'd': 60*60*24,
+    'w': 60*60*24*7,
+    'y': 60*60*24*365
     }
 
+DNS_CLASSES = ('IN', 'CS', 'CH', 'HS')
+
+# Header: ID, flags, QDCOUNT, ANCOUNT, NSCOUNT, ARCOUNT
+HEADER = struct.Struct('!HHHHHH')
+# Answer RR: name pointer, type, class, TTL, RDLENGTH
+ANSWER_RR = struct.Struct('!HHHIH')
+# Question: QTYPE, QCLASS
+QUESTION = struct.Struct('!HH')
+# RR after its owner name: TYPE, CLASS, TTL, RDLENGTH
+RR_FIXED = struct.Struct('!HHIH')
+
+TYPE_TXT = 16
+OPT_TYPE = 41
+CLASS_IN = 1
+CLASS_CH = 3
+RCODE_OK = 0
+RCODE_NXDOMAIN = 3
+RCODE_REFUSED = 5
+FLAG_TC = 0x0200
+MAX_POINTERS = 16
+
+SNAPSHOT_MAGIC = b'DNSSNAP2'
+# Snapshot header: number of zone apexes, number of hash slots (a power of two)
+SNAPSHOT_HEADER = struct.Struct('!II')
+# Hash slot: file offset of the entry for a name, 0 if empty
+SNAPSHOT_SLOT = struct.Struct('!I')
+# Snapshot entry after its name: flags, A count and length, AAAA count and length
+SNAPSHOT_ENTRY = struct.Struct('!BHIHI')
+SNAP_NAME = 1                           # The name exists (see ZoneStore.names)
+SNAP_A = 2                              # There is an A answer, maybe empty
+SNAP_AAAA = 4                           # There is an AAAA answer, maybe empty
+# EDNS0 OPT record advertising our UDP payload size
+OPT_RR = b'\x00' + RR_FIXED.pack(OPT_TYPE, UDP_SIZE, 0, 0)
+
 # Done
 def val_to_bytes(value: int, n_bytes: int) -> list:
     '''Split a value into n bytes'''
@@ -65,45 +124,99 @@ def get_right_bits(bytes_lst: list, n_bits) -> int:
         byteStr += "1"
     return num & bytes_to_val([int(bytes(byteStr,"utf8"),2)])
 
+# Done
+def parse_ttl(ttl: str) -> int:
+    '''Convert a TTL such as 86400, 1D or 3h30m to seconds'''
+    if ttl.isdigit():
+        return int(ttl)
+    if re.fullmatch(r'(?:\d+[smhdwy])+', ttl.lower()) is None:
+        raise ValueError("Bad TTL: {}".format(ttl))
+    return sum(int(num) * TTL_SEC[unit] for num, unit in re.findall(r'(\d+)([smhdwy])', ttl.lower()))
+
+# Done
+def tokenize_zone(zone_file) -> iter:
+    '''Yield (starts with blank, tokens) for every logical line of a master file'''
+    tokens = []
+    blank = False
+    depth = 0                                   # Open parentheses
+    for line in zone_file:
+        if depth == 0:
+            tokens = []
+            blank = line[:1] in (" ", "\t")
+
+        for quoted, word, paren in re.findall(r'("(?:[^"\\]|\\.)*")|([^\s"();]+)|([()]|;)', line):
+            if paren == ";":                    # Comment runs to the end of the line
+                break
+            elif paren == "(":
+                depth += 1
+            elif paren == ")":
+                depth -= 1
+            else:
+                tokens.append(quoted or word)
+
+        if depth == 0 and tokens:
+            yield (blank, tokens)
+
+    if depth != 0:
+        raise ValueError("Unbalanced parentheses")
+
+# Done
+def iter_zone_file(filename: str) -> iter:
+    '''Stream (origin, owner, ttl, class, type, rdata) records from a master file'''
+    origin = None
+    default_ttl = None
+    owner = None
+    last_ttl = None
+    with open(filename) as zone_file:
+        for blank, tokens in tokenize_zone(zone_file):
+            if tokens[0].upper() == "$ORIGIN":
+                origin = qualify(tokens[1], origin or "")
+                continue
+            if tokens[0].upper() == "$TTL":
+                default_ttl = parse_ttl(tokens[1])
+                continue
+            if tokens[0].startswith("$"):
+                raise ValueError("Unsupported directive: {}".format(tokens[0]))
+
+            if not blank:                       # Otherwise the owner is the previous one
+                owner = qualify(tokens.pop(0), origin)
+            if owner is None:
+                raise ValueError("Record without an owner name")
+
+            ttl = None
+            c = "IN"
+            while tokens and (tokens[0][0].isdigit() or tokens[0].upper() in DNS_CLASSES):
+                if tokens[0][0].isdigit():
+                    ttl = parse_ttl(tokens.pop(0))
+                else:
+                    c = tokens.pop(0).upper()
+            if ttl is None:
+                ttl = default_ttl if default_ttl is not None else last_ttl
+            if ttl is None or len(tokens) < 2:
+                raise ValueError("Incomplete record for {}".format(owner))
+            last_ttl = ttl
+
+            yield (origin, owner, ttl, c, tokens[0].upper(), " ".join(tokens[1:]))
+
 # Done
 def read_zone_file(filename: str) -> tuple:
     '''Read the zone file and build a dictionary'''
+    origin = None
     zone = dict()
-    with open(filename) as zone_file:
-        origin = zone_file.readline().split()[1].rstrip('.')
-        defaultTTL = zone_file.readline().split()[1]
-
-        line = zone_file.readline()
-        dom = ""
-        while line != "":
-            sl = line.split()
-            if "1" not in sl[0]:        # Either new domain or old domain and no ttl
-                if "I" not in sl[0]:    # New domain name
-                    dom = sl[0]         # Reassign dom
-                    zone[dom] = []      # Set dom in dict
-                    if "1" in sl[1]:    # All items are present
-                        ttl = sl[1]     # Assign all items
-                        c = sl[2]
-                        ty = sl[3]
-                        addr = sl[4]
-                    else:               # ttl not present
-                        ttl = defaultTTL
-                        c = sl[1]       # Assign all other items
-                        ty = sl[2]
-                        addr = sl[3]
-                else:                   # Old domain and no ttl
-                    ttl = defaultTTL
-                    c = sl[0]
-                    ty = sl[1]
-                    addr = sl[2]
-            else:                       # Old domain and we have a ttl
-                ttl = sl[0]
-                c = sl[1]
-                ty = sl[2]
-                addr = sl[3]
-
-            zone[dom].append((ttl,c,ty,addr))
-            line = zone_file.readline()
+    for rr_origin, owner, ttl, c, ty, addr in iter_zone_file(filename):
+        if origin is None:
+            origin = rr_origin
+        if origin is None:
+            raise ValueError("No $ORIGIN before {}".format(owner))
+        if owner == origin:                     # Keys are relative to the first $ORIGIN
+            dom = "@"
+        elif owner.endswith("." + origin):
+            dom = owner[:-len(origin) - 1]
+        else:
+            dom = owner + "."
+        zone.setdefault(dom, []).append((ttl, c, ty, addr))
+    if origin is None:
+        raise ValueError("No records in {}".format(filename))
 
     return (origin, zone)
 
@@ -111,7 +224,7 @@ def read_zone_file(filename: str) -> tuple:
 def traverse_dom(resp_bytes: bytes, offset: int) -> (str,int):
     dom = ""
     while bytes_to_val(resp_bytes[offset:offset+1]) != 0:
-        domComp = resp_bytes[ offset + 1 : offset + resp_bytes[offset] + 1 ].decode()
+        domComp = str(resp_bytes[ offset + 1 : offset + resp_bytes[offset] + 1 ], "utf8")   # Works on memoryview too
         offset += resp_bytes[offset] + 1
         dom += domComp + "."
 
@@ -119,95 +232,896 @@ def traverse_dom(resp_bytes: bytes, offset: int) -> (str,int):
 
     return (dom,offset)
 
+class Query:
+    '''A parsed DNS query, holding offsets into the original request buffer'''
+    __slots__ = ('buf', 'trans_id', 'flags', 'name', 'qry_type', 'qry_class', 'q_end', 'udp_size')
+
+    def __init__(self, buf: memoryview, trans_id: int, flags: int, name: str,
+                 qry_type: int, qry_class: int, q_end: int, udp_size: int):
+        self.buf = buf
+        self.trans_id = trans_id
+        self.flags = flags
+        self.name = name                # Lower case, without the trailing dot
+        self.qry_type = qry_type
+        self.qry_class = qry_class
+        self.q_end = q_end              # The question is buf[12:q_end]
+        self.udp_size = udp_size        # EDNS0 payload size, None without an OPT record
+
+    def question(self) -> memoryview:
+        '''The question section, to be echoed in the response'''
+        return self.buf[12:self.q_end]
+
+# Done
+def read_name(buf: memoryview, offset: int) -> tuple:
+    '''Read a (possibly compressed) domain name, return it and the offset past it'''
+    labels = []
+    end = None
+    jumps = 0
+    while buf[offset] != 0:
+        length = buf[offset]
+        if length & 0xc0 == 0xc0:                   # Compression pointer
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > MAX_POINTERS:
+                raise ValueError("Compression loop")
+            offset = ((length & 0x3f) << 8) | buf[offset + 1]
+        elif length & 0xc0:
+            raise ValueError("Unknown label type")
+        else:
+            labels.append(str(buf[offset + 1 : offset + length + 1], "ascii"))
+            offset += length + 1
+
+    return (".".join(labels).lower(), offset + 1 if end is None else end)
+
+# Done
+def skip_name(buf: memoryview, offset: int) -> int:
+    '''Return the offset past a domain name without decoding it'''
+    while buf[offset] != 0:
+        if buf[offset] & 0xc0 == 0xc0:              # A pointer always ends the name
+            return offset + 2
+        offset += buf[offset] + 1
+    return offset + 1
+
+# Done
+def parse_query(msg_req: bytes) -> Query:
+    '''Parse the request without copying it'''
+    buf = memoryview(msg_req)
+    try:
+        trans_id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(buf)
+        if qdcount != 1:
+            raise ValueError("Expected one question")
+        name, offset = read_name(buf, 12)
+        qry_type, qry_class = QUESTION.unpack_from(buf, offset)
+        q_end = offset + 4
+
+        udp_size = None
+        offset = q_end
+        for index in range(ancount + nscount + arcount):
+            offset = skip_name(buf, offset)
+            rr_type, rr_class, _, rdlength = RR_FIXED.unpack_from(buf, offset)
+            if rr_type == OPT_TYPE and index >= ancount + nscount:
+                udp_size = max(rr_class, UDP_SIZE)  # CLASS holds the requestor's payload size
+            offset += RR_FIXED.size + rdlength
+    except (IndexError, struct.error):
+        raise ValueError("Malformed request")
+
+    if qry_class == CLASS_CH and qry_type == TYPE_TXT:     # Statistics, see Stats.lookup
+        pass
+    elif qry_type not in (1, 28):
+        raise ValueError("Unknown query type")
+    elif qry_class != CLASS_IN:
+        raise ValueError("Unknown class")
+
+    return Query(buf, trans_id, flags, name, qry_type, qry_class, q_end, udp_size)
+
 # Done
 def parse_request(origin: str, msg_req: bytes) -> tuple:
     '''Parse the request'''
-    transID = bytes_to_val(msg_req[:2])                         # Increment the Transaction ID
-    index = 12                                                  # Skip to the query
-    q = msg_req[12:]                                            # Query is the entire message sans header
-    fullDom, index = traverse_dom(msg_req, index)
+    query = parse_query(msg_req)
+    fullDom = query.name
 
     if fullDom[fullDom.index(".")+1:] != origin:
         raise ValueError("Unknown zone")
 
     queryDom = fullDom.split(".")[0]
 
-    if bytes_to_val(msg_req[-4:-2]) not in (1,28):
-        raise ValueError("Unknown query type")
-    else:
-        q_type = bytes_to_val(q[-4:-2])                         # Get the DNS type
-        index += 2
+    return (query.trans_id, queryDom, query.qry_type, query.question())
 
-    if bytes_to_val(msg_req[-2:]) != 1:
-        raise ValueError("Unknown class")
+# Done
+def compile_records(records: list, qry_type: int) -> tuple:
+    '''Build the answer section for all records of one type'''
+    rr_type = DNS_TYPES[qry_type]
+    family = AF_INET if qry_type == 1 else AF_INET6
 
-    return (transID,queryDom,q_type,q)
+    count = 0
+    ans = bytearray()
+    for ttl, _, ty, addr in records:
+        if ty == rr_type:                               # If an entry is of the same DNS type
+            try:
+                rdata = inet_pton(family, addr)         # Address in network byte order
+            except OSError:
+                raise ValueError("Bad {} address: {}".format(rr_type, addr))
+            ans += ANSWER_RR.pack(0xc00c, qry_type, 1, ttl, len(rdata))
+            ans += rdata
+            count += 1
+
+    return (count, bytes(ans))
 
 # Done
-def format_response(zone: dict, trans_id: int, qry_name: str, qry_type: int, qry: bytearray) -> bytearray:
+def compile_zone(zone: dict) -> dict:
+    '''Precompile the answer section of every (name, type) pair in the zone'''
+    answers = dict()
+    for name, records in zone.items():
+        for qry_type in (1, 28):
+            answers[(name, qry_type)] = compile_records(records, qry_type)
+
+    return answers
+
+# Done
+def format_response(zone: dict, trans_id: int, qry_name: str, qry_type: int, qry: bytes) -> bytes:
     '''Format the response'''
+    count, ans = compile_records(zone[qry_name], qry_type)
+    return HEADER.pack(trans_id, 0x8100, 1, count, 0, 0) + qry + ans
 
-    zoneInfo = zone[qry_name]                           # Get the zone information
-    ans = []
-    for i in zoneInfo:
-        if i[2] == DNS_TYPES[qry_type]:                 # If an entry is of the same DNS type
-            ans.append(i)                               # Add it to the answers
-
-    resp = bytearray()
-    resp.extend(val_to_bytes(trans_id,2))               # Add Transaction ID
-    resp.extend([0x81,0x00])                            # Add Flags
-    resp.extend(val_to_bytes(1,2))                      # Add number of questions
-    resp.extend(val_to_bytes(len(ans),2))               # Add number of answers
-    resp.extend(val_to_bytes(0,4))                      # Add number of additional/authority records
-    resp += qry                                         # Add the query
-
-    for aTup in ans:
-        resp.extend([0xc0,0x0c])                        # Add label for domain name
-        resp.extend(val_to_bytes(qry_type,2))           # Add query type
-        resp.extend(val_to_bytes(1,2))                  # Add query class
-        resp.extend(val_to_bytes(TTL_SEC[aTup[0]],4))   # Add time to live
-
-        if qry_type == 1:                               # If type 'A'
-            addrPts = aTup[3].split(".")
-            resp.extend(val_to_bytes(len(addrPts),2))   # Add length of address
-            for pt in addrPts:
-                resp.append(int(pt))                    # Add part of address
-
-        else:                                           # If type 'AAAA'
-            addrPts = aTup[3].split(":")
-            resp.extend(val_to_bytes(len(addrPts)*2,2)) # Add length of address (each part is made up of 2 bytes)
-            for pt in addrPts:
-                resp.extend(val_to_bytes(int(pt,16),2)) # Add part of address
-
-    return resp
-
-# Done
-def run(filename: str) -> None:
-    '''Main server loop'''
-    server_sckt = socket(AF_INET, SOCK_DGRAM)
+# Done
+def format_cached_response(answers: dict, trans_id: int, qry_name: str, qry_type: int, qry: bytes) -> bytes:
+    '''Format the response from a compiled zone (see compile_zone)'''
+    count, ans = answers[(qry_name, qry_type)]
+    return HEADER.pack(trans_id, 0x8100, 1, count, 0, 0) + qry + ans
+
+# Done
+def qualify(name: str, origin: str) -> str:
+    '''Turn an owner name from a zone file into a lower case absolute name'''
+    if name == "@":
+        return origin
+    if name.endswith("."):
+        return name.rstrip(".").lower()
+    if not origin:
+        return name.lower()
+    return (name + "." + origin).lower()
+
+
+class ZoneNode:
+    '''One label in the trie of zone apexes, indexed right to left'''
+    __slots__ = ('children', 'origin')
+
+    def __init__(self):
+        self.children = dict()
+        self.origin = None              # Set if a zone is rooted here
+
+
+class ZoneStore:
+    '''Compiled answers for every zone served'''
+
+    def __init__(self):
+        self.answers = dict()           # (name, type) -> (answer count, answer section)
+        self.names = dict()             # Owner names and empty non-terminals -> reference count
+        self.apexes = ZoneNode()
+        self.snapshots = []             # Mapped snapshots, looked up after the dicts
+
+    def add_apex(self, origin: str) -> None:
+        '''Mark origin as the apex of a zone we serve'''
+        node = self.apexes
+        for label in reversed(origin.split(".")):
+            node = node.children.setdefault(label, ZoneNode())
+        node.origin = origin
+
+    def add_zone(self, origin: str, zone: dict) -> None:
+        '''Compile a zone as returned by read_zone_file'''
+        origin = origin.lower()
+        self.add_apex(origin)
+        self.names[origin] = self.names.get(origin, 0) + 1
+
+        for name, records in zone.items():
+            self.add_name(origin, qualify(name, origin), records)
+
+    def copy(self) -> 'ZoneStore':
+        '''Copy the indexes, sharing the compiled answers, so that a copy can be updated while this one serves'''
+        store = ZoneStore()
+        store.answers = dict(self.answers)
+        store.names = dict(self.names)
+        store.apexes = self.apexes
+        store.snapshots = list(self.snapshots)
+        return store
+
+    def add_name(self, origin: str, name: str, records: list) -> None:
+        '''Compile the records of one owner name'''
+        for qry_type in (1, 28):
+            self.answers[(name, qry_type)] = compile_records(records, qry_type)
+
+        # Count the name and every ancestor below the apex so that
+        # empty non-terminals answer NODATA rather than NXDOMAIN
+        while name.endswith("." + origin):
+            self.names[name] = self.names.get(name, 0) + 1
+            name = name[name.index(".") + 1:]
+
+    def remove_name(self, origin: str, name: str) -> None:
+        '''Undo add_name'''
+        for qry_type in (1, 28):
+            self.answers.pop((name, qry_type), None)
+
+        while name.endswith("." + origin):
+            refs = self.names[name] - 1
+            if refs:
+                self.names[name] = refs
+            else:
+                del self.names[name]
+            name = name[name.index(".") + 1:]
+
+    def find_zone(self, name: str) -> str:
+        '''Return the origin of the closest enclosing zone, or None'''
+        origin = None
+        node = self.apexes
+        for label in reversed(name.split(".")):
+            node = node.children.get(label)
+            if node is None:
+                break
+            if node.origin is not None:
+                origin = node.origin
+        return origin
+
+    def lookup(self, name: str, qry_type: int) -> tuple:
+        '''Return (rcode, answer count, answer section) for a query'''
+        hit = self.answers.get((name, qry_type))
+        if hit is not None:
+            return (RCODE_OK, hit[0], hit[1])
+        if name in self.names:          # Name exists, no records of this type
+            return (RCODE_OK, 0, b"")
+        for snapshot in self.snapshots:
+            hit = snapshot.lookup(name, qry_type)
+            if hit is not None:
+                return hit
+        if self.find_zone(name) is None:
+            return (RCODE_REFUSED, 0, b"")
+        return (RCODE_NXDOMAIN, 0, b"")
+
+# Done
+def is_snapshot(filename: str) -> bool:
+    '''Tell a snapshot written by save_snapshot from a master file'''
+    with open(filename, "rb") as zone_file:
+        return zone_file.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+# Done
+def load_zones(filenames: list) -> ZoneStore:
+    '''Read and compile every zone file or snapshot'''
+    store = ZoneStore()
+    for filename in filenames:
+        if is_snapshot(filename):
+            load_snapshot(filename, store)
+        else:
+            origin, zone = read_zone_file(filename)
+            store.add_zone(origin, zone)
+    return store
+
+def snapshot_slot(name: bytes, n_slots: int) -> int:
+    '''First hash slot to probe for a name; crc32 is the same in every process'''
+    return zlib.crc32(name) & (n_slots - 1)
+
+
+class Snapshot:
+    '''A snapshot written by save_snapshot, answered from the live mapping:
+    a name is hashed to its slot, and the slot gives the offset of its entry'''
+
+    def __init__(self, filename: str):
+        with open(filename, "rb") as snap_file:
+            self.map = mmap.mmap(snap_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            self.map.close()
+            raise ValueError("Not a zone snapshot: {}".format(filename))
+        offset = len(SNAPSHOT_MAGIC)
+        n_origins, self.n_slots = SNAPSHOT_HEADER.unpack_from(self.map, offset)
+        offset += SNAPSHOT_HEADER.size
+
+        self.origins = []
+        for _ in range(n_origins):
+            end = offset + 1 + self.map[offset]
+            self.origins.append(self.map[offset + 1:end].decode("ascii"))
+            offset = end
+        self.slots = offset
+
+    def find(self, name: bytes) -> int:
+        '''Offset of the entry after the name, or None'''
+        snap = self.map
+        mask = self.n_slots - 1
+        slot = snapshot_slot(name, self.n_slots)
+        while True:
+            offset = SNAPSHOT_SLOT.unpack_from(snap, self.slots + slot * SNAPSHOT_SLOT.size)[0]
+            if not offset:
+                return None
+            end = offset + 1 + snap[offset]
+            if snap[offset + 1:end] == name:
+                return end
+            slot = (slot + 1) & mask    # Linear probing
+
+    def lookup(self, name: str, qry_type: int) -> tuple:
+        '''Like ZoneStore.lookup, or None if the name is not in the snapshot'''
+        try:
+            offset = self.find(name.encode("ascii"))
+        except UnicodeEncodeError:
+            return None
+        if offset is None:
+            return None
+        flags, a_count, a_len, aaaa_count, aaaa_len = SNAPSHOT_ENTRY.unpack_from(self.map, offset)
+        offset += SNAPSHOT_ENTRY.size
+        if qry_type == 1 and flags & SNAP_A:
+            return (RCODE_OK, a_count, self.map[offset:offset + a_len])
+        if qry_type == 28 and flags & SNAP_AAAA:
+            offset += a_len
+            return (RCODE_OK, aaaa_count, self.map[offset:offset + aaaa_len])
+        if flags & SNAP_NAME:
+            return (RCODE_OK, 0, b"")
+        return None
+
+    def entries(self):
+        '''(name, exists, {type: (count, answer)}) of every name, to save again'''
+        for slot in range(self.n_slots):
+            offset = SNAPSHOT_SLOT.unpack_from(self.map, self.slots + slot * SNAPSHOT_SLOT.size)[0]
+            if not offset:
+                continue
+            end = offset + 1 + self.map[offset]
+            name = self.map[offset + 1:end].decode("ascii")
+            flags, a_count, a_len, aaaa_count, aaaa_len = SNAPSHOT_ENTRY.unpack_from(self.map, end)
+            end += SNAPSHOT_ENTRY.size
+            answers = dict()
+            if flags & SNAP_A:
+                answers[1] = (a_count, self.map[end:end + a_len])
+            if flags & SNAP_AAAA:
+                answers[28] = (aaaa_count, self.map[end + a_len:end + a_len + aaaa_len])
+            yield name, bool(flags & SNAP_NAME), answers
+
+# Done
+def save_snapshot(store: ZoneStore, filename: str) -> None:
+    '''Write the compiled zones to a binary snapshot: the zone apexes, a hash
+    table of entry offsets, then one entry per name with its answers'''
+    origins = []
+    pending = [store.apexes]
+    while pending:
+        node = pending.pop()
+        if node.origin is not None:
+            origins.append(node.origin)
+        pending.extend(node.children.values())
+
+    entries = dict()                    # Name -> [exists, {type: (count, answer)}]
+    for snapshot in store.snapshots:
+        for name, exists, answers in snapshot.entries():
+            entries[name] = [exists, answers]
+    for name in store.names:
+        entries.setdefault(name, [False, dict()])[0] = True
+    for (name, qry_type), answer in store.answers.items():
+        if qry_type in (1, 28):
+            entries.setdefault(name, [False, dict()])[1][qry_type] = answer
+
+    n_slots = 1
+    while n_slots < 2 * len(entries):   # At most half full, so that probes stay short
+        n_slots *= 2
+    head = SNAPSHOT_MAGIC + SNAPSHOT_HEADER.pack(len(origins), n_slots)
+    head += b"".join(bytes([len(origin)]) + origin.encode("ascii") for origin in origins)
+    slots = [0] * n_slots
+    body = bytearray()
+    base = len(head) + n_slots * SNAPSHOT_SLOT.size
+    for name, (exists, answers) in entries.items():
+        encoded = name.encode("ascii")
+        slot = snapshot_slot(encoded, n_slots)
+        while slots[slot]:
+            slot = (slot + 1) & (n_slots - 1)
+        slots[slot] = base + len(body)
+
+        a_count, a_ans = answers.get(1, (0, b""))
+        aaaa_count, aaaa_ans = answers.get(28, (0, b""))
+        flags = (SNAP_NAME if exists else 0) | (SNAP_A if 1 in answers else 0) | (SNAP_AAAA if 28 in answers else 0)
+        body += bytes([len(encoded)]) + encoded
+        body += SNAPSHOT_ENTRY.pack(flags, a_count, len(a_ans), aaaa_count, len(aaaa_ans)) + a_ans + aaaa_ans
+
+    # Servers may have the old snapshot mapped: replace it, never rewrite it in place
+    temp = filename + ".tmp"
+    with open(temp, "wb") as snap_file:
+        snap_file.write(head)
+        snap_file.write(b"".join(SNAPSHOT_SLOT.pack(offset) for offset in slots))
+        snap_file.write(body)
+    os.replace(temp, filename)
+
+# Done
+def load_snapshot(filename: str, store: ZoneStore = None) -> ZoneStore:
+    '''Map a snapshot written by save_snapshot and serve its zones from the store,
+    which reads the mapping for every lookup instead of copying it into dicts'''
+    store = store if store is not None else ZoneStore()
+    snapshot = Snapshot(filename)
+    for origin in snapshot.origins:
+        store.add_apex(origin)
+    store.snapshots.append(snapshot)
+    return store
+
+class ZoneWatcher(Thread):
+    '''Poll the zone files and swap in a recompiled ZoneStore when they change'''
+
+    def __init__(self, filenames: list, interval: float = RELOAD_SEC):
+        super().__init__(daemon=True)
+        self.filenames = filenames
+        self.interval = interval
+        self.stop_event = Event()
+        self.stamps = dict()            # File name -> (mtime, size) when last compiled
+        self.zones = dict()             # Master file name -> (origin, zone) when last compiled
+        self.store = self.load()        # Serving code reads this reference once per query
+
+    def run(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            self.check()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+    def load(self) -> ZoneStore:
+        '''Compile every file from scratch'''
+        store = ZoneStore()
+        stamps = dict()
+        zones = dict()
+        for filename in self.filenames:
+            stamps[filename] = file_stamp(filename)
+            if is_snapshot(filename):
+                load_snapshot(filename, store)
+            else:
+                zones[filename] = read_zone_file(filename)
+                store.add_zone(*zones[filename])
+
+        self.stamps = stamps
+        self.zones = zones
+        return store
+
+    def check(self) -> int:
+        '''Recompile the owner names that changed on disk, return how many did'''
+        store = None
+        changed = 0
+        for filename in self.filenames:
+            try:
+                stamp = file_stamp(filename)
+                if stamp == self.stamps[filename]:
+                    continue
+                self.stamps[filename] = stamp       # Do not retry a broken file until it changes again
+                if filename not in self.zones or is_snapshot(filename):
+                    self.store = self.load()
+                    print('Reloaded all zones: {} changed'.format(filename))
+                    return len(self.store.names)
+                origin, zone = read_zone_file(filename)
+                old_origin, old_zone = self.zones[filename]
+                if origin != old_origin:
+                    self.store = self.load()
+                    print('Reloaded all zones: origin of {} changed'.format(filename))
+                    return len(self.store.names)
+
+                # Compile into a copy, thrown away if any record is bad
+                new_store = (store if store is not None else self.store).copy()
+                names = [name for name in old_zone.keys() | zone.keys() if old_zone.get(name) != zone.get(name)]
+                for name in names:
+                    if name in old_zone:
+                        new_store.remove_name(origin, qualify(name, origin))
+                    if name in zone:
+                        new_store.add_name(origin, qualify(name, origin), zone[name])
+            except (OSError, ValueError) as err:
+                print('Keeping the old zones: {}'.format(err))
+                continue
+
+            store = new_store
+            self.zones[filename] = (origin, zone)
+            changed += len(names)
+            print('Reloaded {}: {} names changed'.format(filename, len(names)))
+
+        if store is not None:
+            self.store = store              # A single reference swap, readers see old or new
+        return changed
+
+# Done
+def file_stamp(filename: str) -> tuple:
+    '''Modification time and size, to notice a changed file'''
+    stat = os.stat(filename)
+    return (stat.st_mtime_ns, stat.st_size)
+
+# Done
+def make_socket(reuse_port: bool = False, sock_type: int = SOCK_DGRAM) -> socket:
+    '''Create and bind the server socket'''
+    server_sckt = socket(AF_INET, sock_type)
+    if sock_type == SOCK_STREAM:
+        server_sckt.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reuse_port:                                  # Let several workers bind HOST:PORT
+        server_sckt.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
     server_sckt.bind((HOST, PORT))
-    origin, zone = read_zone_file(filename)
-    print("Listening on %s:%d" % (HOST, PORT))
+    if sock_type == SOCK_STREAM:
+        server_sckt.listen(TCP_BACKLOG)
+    return server_sckt
+
+# Done
+def format_answer(query: Query, rcode: int, count: int, ans: bytes, tcp: bool = False,
+                  truncate: bool = True) -> bytes:
+    '''Format the response to a parsed query, echoing EDNS0 if the client used it;
+    an answer too big for UDP is cut to TC only if truncate says TCP is served'''
+    flags = 0x8100 | rcode
+    if query.udp_size is None:
+        arcount, opt, limit = 0, b"", UDP_SIZE
+    else:
+        arcount, opt, limit = 1, OPT_RR, query.udp_size
+
+    msg_resp = HEADER.pack(query.trans_id, flags, 1, count, 0, arcount) + query.question() + ans + opt
+    if len(msg_resp) > limit and not tcp and truncate:           # Drop the answers and set TC so the client retries over TCP
+        msg_resp = HEADER.pack(query.trans_id, flags | FLAG_TC, 1, 0, 0, arcount) + query.question() + opt
+    return msg_resp
+
+# Done
+def format_query_response(store: ZoneStore, query: Query, tcp: bool = False, truncate: bool = True) -> bytes:
+    '''Look up a parsed query and format the response'''
+    return format_answer(query, *store.lookup(query.name, query.qry_type), tcp, truncate)
+
+
+class RateLimitedLog:
+    '''Print at most `rate` messages a second, from a background thread'''
+
+    def __init__(self, rate: int = LOG_RATE):
+        self.rate = rate
+        self.window = 0                 # Second the counts below belong to
+        self.logged = 0
+        self.suppressed = 0
+        self.queue = SimpleQueue()
+        self.thread = None
 
-    while True:
-        (request_msg, client_addr) = server_sckt.recvfrom(512)
+    def start(self) -> None:
+        '''Start the printing thread (after any fork)'''
+        self.thread = Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def drain(self) -> None:
+        while True:
+            msg = self.queue.get()
+            if isinstance(msg, Event):  # Queued by flush
+                msg.set()
+            else:
+                print(msg)
+
+    def flush(self, timeout: float = 1) -> None:
+        '''Print what is queued and flush stdout, before os._exit skips both'''
+        if self.suppressed:
+            self.queue.put('Suppressed {} messages'.format(self.suppressed))
+            self.suppressed = 0
+        if self.thread is not None and self.thread.is_alive():
+            done = Event()
+            self.queue.put(done)
+            done.wait(timeout)
+        sys.stdout.flush()
+
+    def log(self, msg: str) -> None:
+        now = int(time.monotonic())
+        if now != self.window:
+            if self.suppressed:
+                self.queue.put('Suppressed {} messages'.format(self.suppressed))
+            self.window = now
+            self.logged = 0
+            self.suppressed = 0
+
+        if self.logged < self.rate:
+            self.logged += 1
+            self.queue.put(msg)
+        else:
+            self.suppressed += 1
+
+
+class Stats:
+    '''Counters and per-stage timing histograms of one worker, which owns them and needs no lock'''
+
+    def __init__(self, worker_id: int = 0):
+        self.worker_id = worker_id
+        self.counters = {'queries': 0, 'hits': 0, 'nodata': 0, 'nxdomain': 0, 'refused': 0,
+                         'truncated': 0, 'ignored': 0, 'dropped': 0}
+        self.qtypes = dict()
+        # Bucket i counts the stage durations of i significant bits, in nanoseconds
+        self.timings = {stage: [0] * 64 for stage in STAGES}
+
+    def lookup(self, name: str) -> tuple:
+        '''Answer a CHAOS TXT query for the statistics'''
+        if name not in STATS_NAMES:
+            return (RCODE_REFUSED, 0, b"")
+        strings = [line.encode("ascii") for line in self.report()]
+        ans = b"".join(ANSWER_RR.pack(0xc00c, TYPE_TXT, CLASS_CH, 0, len(txt) + 1) + bytes([len(txt)]) + txt
+                       for txt in strings)
+        return (RCODE_OK, len(strings), ans)
+
+    def percentile(self, stage: str, pct: float) -> int:
+        '''Upper bound of the bucket holding the percentile, in nanoseconds'''
+        hist = self.timings[stage]
+        rank = sum(hist) * pct / 100
+        seen = 0
+        for bucket, count in enumerate(hist):
+            seen += count
+            if count and seen >= rank:
+                return 1 << bucket
+        return 0
+
+    def report(self) -> list:
+        '''One line per counter, query type and stage'''
+        lines = ['worker={} pid={}'.format(self.worker_id, os.getpid())]
+        lines.extend('{}={}'.format(key, val) for key, val in self.counters.items())
+        lines.extend('qtype.{}={}'.format(DNS_TYPES.get(qry_type, qry_type), count)
+                     for qry_type, count in sorted(self.qtypes.items()))
+        lines.extend('{} n={} p50<={}ns p99<={}ns'.format(
+            stage, sum(self.timings[stage]), self.percentile(stage, 50), self.percentile(stage, 99))
+                     for stage in STAGES)
+        return lines
+
+# Done
+def answer_query(store: ZoneStore, request_msg: bytes, stats: Stats, tcp: bool = False,
+                 truncate: bool = True) -> bytes:
+    '''Answer one request, or return None if it should be ignored'''
+    counters = stats.counters
+    counters['queries'] += 1
+    start = perf_counter_ns()
+    try:
+        query = parse_query(request_msg)
+    except ValueError as ve:
+        counters['ignored'] += 1
+        LOG.log('Ignoring the request: {}'.format(ve))
+        return None
+    parsed = perf_counter_ns()
+
+    stats.qtypes[query.qry_type] = stats.qtypes.get(query.qry_type, 0) + 1
+    if query.qry_class == CLASS_CH:
+        rcode, count, ans = stats.lookup(query.name)
+    else:
+        rcode, count, ans = store.lookup(query.name, query.qry_type)
+    looked_up = perf_counter_ns()
+    msg_resp = format_answer(query, rcode, count, ans, tcp, truncate)
+    done = perf_counter_ns()
+
+    timings = stats.timings
+    timings['parse'][(parsed - start).bit_length()] += 1
+    timings['lookup'][(looked_up - parsed).bit_length()] += 1
+    timings['format'][(done - looked_up).bit_length()] += 1
+
+    if msg_resp[2] & (FLAG_TC >> 8):
+        counters['truncated'] += 1
+    if rcode == RCODE_OK:
+        counters['hits' if count else 'nodata'] += 1
+    elif rcode == RCODE_NXDOMAIN:
+        counters['nxdomain'] += 1
+    else:
+        counters['refused'] += 1
+    return msg_resp
+
+# Done
+def send_reply(sckt: socket, msg_resp: bytes, client_addr: tuple, stats: Stats) -> None:
+    '''Send a reply and time it'''
+    start = perf_counter_ns()
+    try:
+        sckt.sendto(msg_resp, client_addr)
+    except BlockingIOError:                         # Send buffer full, the client will retry
+        stats.counters['dropped'] += 1
+    stats.timings['send'][(perf_counter_ns() - start).bit_length()] += 1
+
+# Done
+def serve(server_sckt: socket, zones: ZoneWatcher, stop: Event, stats: Stats) -> None:
+    '''Answer queries one at a time until stop is set'''
+    server_sckt.settimeout(POLL_SEC)                # Wake up now and then to check for stop
+
+    while not stop.is_set():
         try:
-            trans_id, domain, qry_type, qry = parse_request(origin, request_msg)
-            msg_resp = format_response(zone, trans_id, domain, qry_type, qry)
-            server_sckt.sendto(msg_resp, client_addr)
-        except ValueError as ve:
-            print('Ignoring the request: {}'.format(ve))
-        except KeyError as ke:
-            print('Ignoring the request: {} not in zone.'.format(ke))
+            (request_msg, client_addr) = server_sckt.recvfrom(UDP_SIZE)
+        except timeout:
+            continue
+
+        msg_resp = answer_query(zones.store, request_msg, stats, truncate=False)     # No TCP to retry over
+        if msg_resp is not None:
+            send_reply(server_sckt, msg_resp, client_addr, stats)
+
+# Done
+def serve_batched(server_sckt: socket, zones: ZoneWatcher, stop: Event, stats: Stats, batch_size: int) -> None:
+    '''Drain up to batch_size queries per wakeup, answer them, then flush the replies'''
+    views = [memoryview(bytearray(UDP_SIZE)) for _ in range(batch_size)]    # Reused for every batch
+    server_sckt.setblocking(False)
+
+    while not stop.is_set():
+        readable, _, _ = select([server_sckt], [], [], POLL_SEC)
+        if not readable:
+            continue
+
+        received = []
+        for view in views:
+            try:
+                nbytes, client_addr = server_sckt.recvfrom_into(view)
+            except BlockingIOError:                 # Socket drained
+                break
+            received.append((view[:nbytes], client_addr))
+
+        replies = []
+        store = zones.store
+        for request_msg, client_addr in received:
+            msg_resp = answer_query(store, request_msg, stats, truncate=False)
+            if msg_resp is not None:
+                replies.append((msg_resp, client_addr))
+
+        for msg_resp, client_addr in replies:
+            send_reply(server_sckt, msg_resp, client_addr, stats)
+
+
+class DNSDatagramProtocol(asyncio.DatagramProtocol):
+    '''DNS over UDP for the asyncio server'''
+
+    def __init__(self, zones: ZoneWatcher, stats: Stats):
+        self.zones = zones
+        self.stats = stats
+        self.transport = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        msg_resp = answer_query(self.zones.store, data, self.stats)
+        if msg_resp is not None:
+            start = perf_counter_ns()
+            self.transport.sendto(msg_resp, addr)
+            self.stats.timings['send'][(perf_counter_ns() - start).bit_length()] += 1
+
+
+class DNSStreamProtocol(asyncio.Protocol):
+    '''DNS over TCP: length-prefixed messages, pipelined queries answered in order'''
+
+    def __init__(self, zones: ZoneWatcher, stats: Stats):
+        self.zones = zones
+        self.stats = stats
+        self.transport = None
+        self.loop = None
+        self.buf = bytearray()
+        self.idle = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self.reset_idle()
+
+    def connection_lost(self, exc) -> None:
+        if self.idle is not None:
+            self.idle.cancel()
+
+    def reset_idle(self) -> None:
+        '''Close the connection if the client goes quiet'''
+        if self.idle is not None:
+            self.idle.cancel()
+        self.idle = self.loop.call_later(TCP_IDLE_SEC, self.transport.close)
+
+    def data_received(self, data: bytes) -> None:
+        self.reset_idle()
+        self.buf += data
+
+        replies = []
+        offset = 0
+        while len(self.buf) - offset >= 2:
+            end = offset + 2 + ((self.buf[offset] << 8) | self.buf[offset + 1])
+            if end > len(self.buf):                 # Wait for the rest of the message
+                break
+            msg_resp = answer_query(self.zones.store, self.buf[offset + 2:end], self.stats, tcp=True)
+            if msg_resp is not None:
+                replies.append(struct.pack('!H', len(msg_resp)) + msg_resp)
+            offset = end
+
+        del self.buf[:offset]
+        if replies:
+            self.transport.writelines(replies)
+        if len(self.buf) > TCP_MAX_BUFFER:
+            self.transport.close()
+
+    def pause_writing(self) -> None:
+        self.transport.pause_reading()              # Stop taking queries from a client that does not read
+
+    def resume_writing(self) -> None:
+        self.transport.resume_reading()
+
+# Done
+async def serve_async(udp_sckt: socket, tcp_sckt: socket, zones: ZoneWatcher, stop: Event, stats: Stats) -> None:
+    '''Answer queries over UDP and TCP on one event loop until stop is set'''
+    loop = asyncio.get_running_loop()
+    udp_transport, _ = await loop.create_datagram_endpoint(
+        lambda: DNSDatagramProtocol(zones, stats), sock=udp_sckt)
+    tcp_server = await loop.create_server(lambda: DNSStreamProtocol(zones, stats), sock=tcp_sckt)
+
+    while not stop.is_set():
+        await asyncio.sleep(POLL_SEC)
+
+    udp_transport.close()
+    tcp_server.close()
+    await tcp_server.wait_closed()
+
+# Done
+def run_worker(worker_id: int, server_sckt: socket, zones: ZoneWatcher, batch_size: int = 1,
+               tcp_sckt: socket = None) -> None:
+    '''Serve on one socket until SIGINT or SIGTERM, then report the statistics'''
+    stop = Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    LOG.start()                                     # Threads do not survive a fork, start them here
+    if zones.interval > 0:
+        zones.start()
+
+    stats = Stats(worker_id)
+    if tcp_sckt is not None:
+        asyncio.run(serve_async(server_sckt, tcp_sckt, zones, stop, stats))
+    elif batch_size > 1:
+        serve_batched(server_sckt, zones, stop, stats, batch_size)
+    else:
+        serve(server_sckt, zones, stop, stats)
+    zones.stop()
     server_sckt.close()
+    print('; '.join(stats.report()))
+
+LOG = RateLimitedLog()
+
+# Done
+def run(filenames: list, workers: int = 1, batch_size: int = 1, reload_sec: float = RELOAD_SEC,
+        use_asyncio: bool = False) -> None:
+    '''Main server loop'''
+    zones = ZoneWatcher(filenames, reload_sec)
+
+    if workers == 1:
+        server_sckt = make_socket()
+        tcp_sckt = make_socket(sock_type=SOCK_STREAM) if use_asyncio else None
+        print("Listening on %s:%d" % (HOST, PORT))
+        run_worker(0, server_sckt, zones, batch_size, tcp_sckt)
+        return
+
+    # Bind every socket up front so that errors show before forking
+    sockets = [(make_socket(reuse_port=True),
+                make_socket(reuse_port=True, sock_type=SOCK_STREAM) if use_asyncio else None)
+               for _ in range(workers)]
+    bound = [sckt for pair in sockets for sckt in pair if sckt is not None]
+    pids = []
+    for worker_id, (server_sckt, tcp_sckt) in enumerate(sockets):
+        pid = os.fork()
+        if pid == 0:                                # Child shares the compiled zone copy-on-write
+            for other in bound:
+                if other is not server_sckt and other is not tcp_sckt:
+                    other.close()
+            try:
+                run_worker(worker_id, server_sckt, zones, batch_size, tcp_sckt)
+            finally:
+                LOG.flush()                         # os._exit does not flush stdout
+                os._exit(0)
+        pids.append(pid)
+
+    for server_sckt in bound:
+        server_sckt.close()
+    print("Listening on %s:%d with %d workers" % (HOST, PORT, workers))
+    sys.stdout.flush()
+
+    def shutdown(signum, frame):
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    for pid in pids:
+        os.waitpid(pid, 0)
 
 # Done
 def main(*argv):
     '''Main function'''
-    if len(argv[0]) != 2:
-        print('Proper use: python3 nameserver.py <zone_file>')
-        exit()
-    run(argv[0][1])
+    parser = argparse.ArgumentParser(prog='nameserver.py', description='DNS Name Server')
+    parser.add_argument('zone_files', nargs='+', metavar='zone_file', help='zone files to serve')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='number of processes sharing the port via SO_REUSEPORT')
+    parser.add_argument('--batch', type=int, default=BATCH_SIZE,
+                        help='datagrams to drain per wakeup (1 answers them one at a time)')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='serve UDP and TCP from an asyncio event loop')
+    parser.add_argument('--reload', type=float, default=RELOAD_SEC, metavar='SEC',
+                        help='how often to check the zone files for changes (0 disables)')
+    parser.add_argument('--save-snapshot', metavar='FILE',
+                        help='compile the zones into a binary snapshot and exit')
+    args = parser.parse_args(argv[0][1:])
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.batch < 1:
+        parser.error('--batch must be at least 1')
+    try:
+        if args.save_snapshot:
+            save_snapshot(load_zones(args.zone_files), args.save_snapshot)
+            return
+        run(args.zone_files, args.workers, args.batch, args.reload, args.asyncio)
+    except ValueError as err:                       # A broken zone file
+        parser.error(str(err))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,44 @@
+'''
+Benchmarking the DNS Server
+'''
+#!/usr/bin/python3
+
+
+import pytest
+from nameserver import read_zone_file
+from nameserver import parse_request
+from nameserver import format_response
+from nameserver import parse_query
+from nameserver import format_query_response
+from nameserver import load_zones
+
+pytest.importorskip('pytest_benchmark')
+
+REQUEST = b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01'
+QUERY = b'\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01'
+
+
+class TestBenchmark:
+    '''Microbenchmarks for the request path'''
+
+    @pytest.fixture(scope='function', autouse=True)
+    def setup_class(self):
+        '''Setting up'''
+        self.zone = read_zone_file('zoo.zone')[1]
+        self.store = load_zones(['zoo.zone'])
+
+    def test_parse_request(self, benchmark):
+        '''Parse a request'''
+        assert benchmark(parse_request, 'cs430.luther.edu', REQUEST)[2] == 1
+
+    def test_format_response(self, benchmark):
+        '''Format a response from the zone dictionary'''
+        assert len(benchmark(format_response, self.zone, 14019, 'ant', 1, QUERY)) == 70
+
+    def test_format_query_response(self, benchmark):
+        '''Parse a request and format the response from the compiled zones'''
+        assert len(benchmark(lambda: format_query_response(self.store, parse_query(REQUEST)))) == 70
+
+    def test_read_zone_file(self, benchmark):
+        '''Read the zone file'''
+        assert len(benchmark(read_zone_file, 'zoo.zone')[1]) == 25
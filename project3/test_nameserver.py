@@ -4,6 +4,7 @@ Testing the DNS Server
 #!/usr/bin/python3
 
 
+import asyncio
 from random import seed
 import pytest
 from nameserver import val_to_bytes
@@ -13,6 +14,20 @@ from nameserver import get_right_bits
 from nameserver import read_zone_file
 from nameserver import parse_request
 from nameserver import format_response
+from nameserver import compile_zone
+from nameserver import format_cached_response
+from nameserver import parse_query
+from nameserver import format_query_response
+from nameserver import load_zones
+from nameserver import ZoneStore
+from nameserver import parse_ttl
+from nameserver import save_snapshot
+from nameserver import load_snapshot
+from nameserver import ZoneWatcher
+from nameserver import DNSStreamProtocol
+from nameserver import Stats
+from nameserver import answer_query
+from nameserver import RateLimitedLog
 
 seed(430)
 
@@ -51,6 +66,162 @@ class TestServer:
         assert origin == 'cs430.luther.edu'
         assert len(zone) == 25
 
+    def test_read_zone_file_master_format(self):
+        '''Read a zone file with parentheses, comments and other record types'''
+        origin, zone = read_zone_file('cs430.zone')
+        assert origin == 'cs430.luther.edu'
+        assert sorted(zone) == ['@', 'mail', 'ns', 'roman', 'www']
+        assert zone['@'][0] == (86400, 'IN', 'SOA', 'ns.cs430.luther.edu. admin.cs430.luther.edu. 2018091601 3H 15 1w 3h')
+        assert zone['www'][1] == (86400, 'IN', 'TXT', '"This is a web server"')
+        assert zone['roman'] == [(1, 'IN', 'A', '1.2.3.4'), (3600, 'IN', 'A', '1.2.3.5'),
+                                 (86400, 'IN', 'AAAA', 'abcd:abcd:abcd:abcd:1234:1234:1234:1234')]
+
+    def test_read_zone_file_no_origin(self, tmp_path):
+        '''Records before any $ORIGIN are a ValueError'''
+        zone_file = tmp_path / 'test.zone'
+        zone_file.write_text('$TTL 1h\nant.test. IN A 10.0.0.1\n')
+        with pytest.raises(ValueError):
+            read_zone_file(str(zone_file))
+        zone_file.write_text('$TTL 1h\n')
+        with pytest.raises(ValueError):
+            read_zone_file(str(zone_file))
+
+    def test_parse_ttl(self):
+        '''Convert TTLs with units'''
+        assert parse_ttl('86400') == 86400
+        assert parse_ttl('1D') == 86400
+        assert parse_ttl('3h30m') == 12600
+        with pytest.raises(ValueError):
+            parse_ttl('3x')
+
+    def test_snapshot(self, tmp_path):
+        '''A mapped snapshot answers every lookup the same as its zone files'''
+        store = load_zones(['zoo.zone', 'cs430.zone'])
+        save_snapshot(store, str(tmp_path / 'zones.snap'))
+        loaded = load_snapshot(str(tmp_path / 'zones.snap'))
+        assert loaded.answers == {} and loaded.names == {}
+        for name in list(store.names) + ['nobody.cs430.luther.edu', 'x.luther.edu']:
+            for qry_type in (1, 28, 16):
+                assert loaded.lookup(name, qry_type) == store.lookup(name, qry_type)
+        assert loaded.lookup('x.luther.edu', 1) == (5, 0, b'')
+        # Saving a mapped snapshot again keeps its contents
+        save_snapshot(loaded, str(tmp_path / 'again.snap'))
+        again = load_zones([str(tmp_path / 'again.snap')])
+        for name in store.names:
+            assert again.lookup(name, 1) == store.lookup(name, 1)
+
+    def test_zone_watcher_reload(self, tmp_path):
+        '''Only changed names are recompiled into a new store'''
+        zone_file = tmp_path / 'test.zone'
+        zone_file.write_text('$ORIGIN test.\n$TTL 1h\nant IN A 10.0.0.1\nbee IN A 10.0.0.2\n')
+        zones = ZoneWatcher([str(zone_file)], 0)
+        old_store = zones.store
+        assert zones.check() == 0
+
+        zone_file.write_text('$ORIGIN test.\n$TTL 1h\nant IN A 10.0.0.1\ncat.x IN A 10.0.0.3\n')
+        assert zones.check() == 2
+        assert zones.store is not old_store
+        assert zones.store.answers[('ant.test', 1)] is old_store.answers[('ant.test', 1)]
+        assert zones.store.lookup('bee.test', 1) == (3, 0, b'')
+        assert zones.store.lookup('x.test', 1) == (0, 0, b'')
+        assert zones.store.lookup('cat.x.test', 1)[:2] == (0, 1)
+        assert old_store.lookup('bee.test', 1)[:2] == (0, 1)
+
+        zone_file.write_text('$ORIGIN test.\n$TTL 1h\nant IN A 10.0.0.1\ncat.x IN A\n')
+        new_store = zones.store
+        assert zones.check() == 0
+        assert zones.store is new_store
+
+    def test_zone_watcher_bad_address(self, tmp_path):
+        '''A bad address keeps the old zones, and a later fix is still loaded'''
+        zone_file = tmp_path / 'test.zone'
+        zone_file.write_text('$ORIGIN test.\n$TTL 1h\nant IN A 10.0.0.1\n')
+        zones = ZoneWatcher([str(zone_file)], 0)
+        old_store = zones.store
+
+        zone_file.write_text('$ORIGIN test.\n$TTL 1h\nant IN A 10.0.0.999\n')
+        assert zones.check() == 0
+        assert zones.store is old_store
+        assert zones.store.lookup('ant.test', 1)[:2] == (0, 1)
+
+        zone_file.write_text('$ORIGIN test.\n$TTL 1h\nant IN A 10.0.0.1\nbee IN A 10.0.0.2\n')
+        assert zones.check() == 1
+        assert zones.store.lookup('bee.test', 1)[:2] == (0, 1)
+
+    def test_truncated_response(self):
+        '''Answers that do not fit in UDP set TC unless sent over TCP'''
+        store = ZoneStore()
+        store.add_zone('big.test', {'many': [(3600, 'IN', 'A', '10.0.0.%d' % i) for i in range(40)]})
+        msg = b'\x00\x01\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x04many\x03big\x04test\x00\x00\x01\x00\x01'
+        udp_resp = format_query_response(store, parse_query(msg))
+        assert udp_resp[2:8] == b'\x83\x00\x00\x01\x00\x00'
+        assert len(udp_resp) == len(msg)
+        tcp_resp = format_query_response(store, parse_query(msg), tcp=True)
+        assert tcp_resp[2:8] == b'\x81\x00\x00\x01\x00\x28'
+        # Without a TCP listener to retry over, the whole answer goes over UDP
+        assert format_query_response(store, parse_query(msg), truncate=False) == tcp_resp
+        stats = Stats(0)
+        assert answer_query(store, msg, stats, truncate=False) == tcp_resp
+        assert stats.counters['truncated'] == 0
+
+    def test_stream_protocol_pipelining(self):
+        '''Answer pipelined, length-prefixed queries split across reads'''
+        class Transport:
+            def __init__(self):
+                self.written = []
+            def writelines(self, data):
+                self.written.extend(data)
+            def close(self):
+                pass
+
+        class Zones:
+            store = load_zones(['zoo.zone'])
+
+        async def feed(protocol, *chunks):
+            protocol.connection_made(Transport())
+            written = []
+            for chunk in chunks:
+                protocol.data_received(chunk)
+                written.append(len(protocol.transport.written))
+            protocol.connection_lost(None)
+            return written
+
+        protocol = DNSStreamProtocol(Zones, Stats())
+        msg = b'\x00\x01\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01'
+        framed = (b'\x00' + bytes([len(msg)]) + msg) * 2
+        assert asyncio.run(feed(protocol, framed[:5], framed[5:])) == [0, 2]
+        assert protocol.transport.written[0][2:] == format_query_response(Zones.store, parse_query(msg), tcp=True)
+        assert protocol.stats.counters['hits'] == 2
+        assert not protocol.buf
+
+    def test_stats(self):
+        '''Count queries and answer the CHAOS TXT statistics query'''
+        store = load_zones(['zoo.zone'])
+        stats = Stats(3)
+        msg = b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01'
+        assert answer_query(store, msg, stats) == format_query_response(store, parse_query(msg))
+        assert answer_query(store, msg.replace(b'ant', b'gnu'), stats)[3] == 3
+        assert answer_query(store, msg[:-1], stats) is None
+        assert stats.counters['queries'] == 3
+        assert (stats.counters['hits'], stats.counters['nxdomain'], stats.counters['ignored']) == (1, 1, 1)
+        assert stats.qtypes == {1: 2}
+        assert sum(stats.timings['parse']) == 2
+        assert 0 < stats.percentile('lookup', 50) <= stats.percentile('lookup', 99)
+
+        chaos = b'\x00\x07\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00\x05stats\x06server\x00\x00\x10\x00\x03'
+        resp = answer_query(store, chaos, stats)
+        assert resp[2:8] == b'\x81\x00\x00\x01\x00\x0f'
+        assert b'worker=3' in resp and b'hits=1' in resp and b'qtype.A=2' in resp
+        assert answer_query(store, chaos.replace(b'\x06server', b'\x06client'), stats)[3] == 5
+
+    def test_rate_limited_log(self):
+        '''Messages beyond the rate are counted, not queued'''
+        log = RateLimitedLog(2)
+        for i in range(5):
+            log.log('message {}'.format(i))
+        assert log.queue.qsize() == 2
+        assert log.suppressed == 3
+
     def test_format_response(self):
         '''Format a response'''
         assert format_response(self.zone, 4783, 'ant', 1, b'\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01') == \
@@ -59,6 +230,39 @@ class TestServer:
         assert format_response(self.zone, 55933, 'ant', 28, b'\x03ant\x05cs430\x06luther\x03edu\x00\x00\x1c\x00\x01') == \
                             b'\xda}\x81\x00\x00\x01\x00\x01\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x1c\x00\x01\xc0\x0c\x00\x1c\x00\x01\x00\x00\x0e\x10\x00\x10J\x9ap\xec:\xc0\xc6\x845\x9e\x8d7\x94\x86YY'
 
+    def test_format_cached_response(self):
+        '''Compiled answers match the uncompiled response'''
+        answers = compile_zone(self.zone)
+        assert len(answers) == 2 * len(self.zone)
+        for name in ('ant', 'lion', 'urial'):
+            for qry_type, qry in ((1, b'\x00\x01\x00\x01'), (28, b'\x00\x1c\x00\x01')):
+                qry = bytes([len(name)]) + name.encode() + b'\x05cs430\x06luther\x03edu\x00' + qry
+                assert format_cached_response(answers, 4783, name, qry_type, qry) == \
+                       format_response(self.zone, 4783, name, qry_type, qry)
+
+    def test_zone_store_lookup(self):
+        '''Answers, NODATA, NXDOMAIN and REFUSED'''
+        store = load_zones(['zoo.zone'])
+        rcode, count, ans = store.lookup('ant.cs430.luther.edu', 1)
+        assert (rcode, count) == (0, 2)
+        assert ans == compile_zone(self.zone)[('ant', 1)][1]
+        assert store.lookup('cs430.luther.edu', 1) == (0, 0, b'')
+        assert store.lookup('nope.cs430.luther.edu', 28) == (3, 0, b'')
+        assert store.lookup('luther.edu', 1) == (5, 0, b'')
+
+    def test_zone_store_multiple_zones(self):
+        '''Pick the closest enclosing zone and answer deep names'''
+        store = ZoneStore()
+        store.add_zone('luther.edu', {'www': [(3600, 'IN', 'A', '10.0.0.1')]})
+        store.add_zone('cs430.luther.edu', {'a.b': [(3600, 'IN', 'A', '10.0.0.2')]})
+        assert store.find_zone('x.cs430.luther.edu') == 'cs430.luther.edu'
+        assert store.find_zone('x.luther.edu') == 'luther.edu'
+        assert store.find_zone('luther.com') is None
+        assert store.lookup('a.b.cs430.luther.edu', 1)[:2] == (0, 1)
+        assert store.lookup('b.cs430.luther.edu', 1) == (0, 0, b'')
+        assert store.lookup('c.cs430.luther.edu', 1) == (3, 0, b'')
+        assert store.lookup('www.luther.edu', 1)[:2] == (0, 1)
+
     def test_parse_request(self):
         '''Parse the request'''
         assert parse_request('cs430.luther.edu', b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01') == \
@@ -67,6 +271,36 @@ class TestServer:
         assert parse_request('cs430.luther.edu', b'i\xce\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x1c\x00\x01') == \
                               (27086, 'ant', 28, b'\x03ant\x05cs430\x06luther\x03edu\x00\x00\x1c\x00\x01')
 
+    def test_parse_request_memoryview(self):
+        '''Parse a request received into a reusable buffer'''
+        buf = bytearray(512)
+        msg = b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01'
+        buf[:len(msg)] = msg
+        assert parse_request('cs430.luther.edu', memoryview(buf)[:len(msg)]) == \
+                              (14019, 'ant', 1, b'\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01')
+
+    def test_parse_query_edns(self):
+        '''Parse a request with an EDNS0 OPT record in the additional section'''
+        msg = b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x01\x03ANT\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01' + \
+              b'\x00\x00\x29\x10\x00\x00\x00\x00\x00\x00\x00'
+        query = parse_query(msg)
+        assert (query.trans_id, query.name, query.qry_type, query.qry_class, query.udp_size) == \
+               (14019, 'ant.cs430.luther.edu', 1, 1, 4096)
+        assert query.question() == b'\x03ANT\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01'
+
+        resp = format_query_response(load_zones(['zoo.zone']), query)
+        assert resp[10:12] == b'\x00\x01'
+        assert resp.endswith(b'\x00\x00\x29\x02\x00\x00\x00\x00\x00\x00\x00')
+
+    def test_parse_query_compression(self):
+        '''Follow a compression pointer in the question name'''
+        msg = b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\xc0\x16\x00\x01\x00\x01\x05cs430\x06luther\x03edu\x00'
+        assert parse_query(msg).name == 'ant.cs430.luther.edu'
+        with pytest.raises(ValueError):
+            parse_query(b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\xc0\x0c\x00\x01\x00\x01')
+        with pytest.raises(ValueError):
+            parse_query(b'6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant')
+
     def test_parse_request_query_error(self):
         '''Query type is incorrect'''
         with pytest.raises(ValueError) as excinfo:
@@ -0,0 +1,267 @@
+"""HTTP load generator and latency benchmark for webserver.py"""
+import argparse
+import asyncio
+import os
+import random
+import ssl
+import struct
+import subprocess
+import sys
+import time
+
+from webserver import ADDRESS, PORT
+
+CONCURRENCY = 32
+DURATION_SEC = 10
+NOT_FOUND_RATIO = 0.1
+BAD_METHOD_RATIO = 0.05
+TIMEOUT_SEC = 5
+PATH = "/alice30.txt"
+MISSING_PATH = "/alice30.html"
+
+# pcapng block types and the link layers whose headers we know how to strip
+SECTION_HEADER = 0x0A0D0D0A
+INTERFACE_DESCRIPTION = 1
+SIMPLE_PACKET = 3
+ENHANCED_PACKET = 6
+LINK_HEADERS = {0: 4, 1: 14, 101: 0, 113: 16, 276: 20}   # Null, Ethernet, raw IP, Linux cooked v1/v2
+METHODS = (b"GET ", b"HEAD ", b"POST ", b"PUT ", b"DELETE ", b"OPTIONS ")
+
+def format_request(method, path, keep_alive):
+    request = method + " " + path + " HTTP/1.1\r\n"
+    request += "Host: " + ADDRESS + ":" + str(PORT) + "\r\n"
+    request += "User-Agent: httpperf\r\n"
+    request += "Connection: " + ("keep-alive" if keep_alive else "close") + "\r\n\r\n"
+    return request.encode()
+
+def build_request_mix(keep_alive, not_found_ratio, bad_method_ratio, size=1000):
+    """Requests expected to be answered 200, 404 and 405 in the given proportions"""
+    mix = []
+    for _ in range(size):
+        draw = random.random()
+        if draw < bad_method_ratio:
+            mix.append(format_request("POST", PATH, keep_alive))
+        elif draw < bad_method_ratio + not_found_ratio:
+            mix.append(format_request("GET", MISSING_PATH, keep_alive))
+        else:
+            mix.append(format_request("GET", PATH, keep_alive))
+    return mix
+
+def iter_packets(filename):
+    """Yield (linktype, frame) for every packet in a pcapng file"""
+    with open(filename, "rb") as f:
+        data = f.read()
+    order = "<"
+    linktypes = []
+    offset = 0
+    while offset + 12 <= len(data):
+        if struct.unpack_from("<I", data, offset)[0] == SECTION_HEADER:
+            order = "<" if struct.unpack_from("<I", data, offset + 8)[0] == 0x1A2B3C4D else ">"
+            linktypes = []
+        block_type, length = struct.unpack_from(order + "II", data, offset)
+        if length < 12:
+            raise ValueError("Bad pcapng block length at offset {}".format(offset))
+        body = offset + 8
+        if block_type == INTERFACE_DESCRIPTION:
+            linktypes.append(struct.unpack_from(order + "H", data, body)[0])
+        elif block_type == ENHANCED_PACKET:
+            interface, _, _, captured, _ = struct.unpack_from(order + "IIIII", data, body)
+            yield linktypes[interface], data[body + 20:body + 20 + captured]
+        elif block_type == SIMPLE_PACKET:
+            yield linktypes[0], data[body + 4:offset + length - 4]
+        offset += length
+
+def tcp_payload(linktype, frame):
+    """Payload of a TCP segment over IPv4 or IPv6, or None"""
+    if linktype not in LINK_HEADERS:
+        return None
+    packet = frame[LINK_HEADERS[linktype]:]
+    if not packet:
+        return None
+    version = packet[0] >> 4
+    if version == 4 and len(packet) >= 20 and packet[9] == 6:
+        segment = packet[(packet[0] & 0x0f) * 4:struct.unpack_from("!H", packet, 2)[0]]
+    elif version == 6 and len(packet) >= 40 and packet[6] == 6:
+        segment = packet[40:40 + struct.unpack_from("!H", packet, 4)[0]]
+    else:
+        return None
+    if len(segment) < 20:
+        return None
+    return segment[(segment[12] >> 4) * 4:]
+
+def read_capture(filename):
+    """Request heads of the HTTP requests in a pcapng capture"""
+    requests = []
+    for linktype, frame in iter_packets(filename):
+        payload = tcp_payload(linktype, frame)
+        if payload and payload.startswith(METHODS):
+            end = payload.find(b"\r\n\r\n")
+            if end >= 0:
+                requests.append(payload[:end + 4])
+    return requests
+
+def set_keep_alive(request, keep_alive):
+    """Rewrite the Connection header of a replayed request"""
+    lines = [l for l in request[:-4].split(b"\r\n") if not l.lower().startswith(b"connection:")]
+    lines.append(b"Connection: keep-alive" if keep_alive else b"Connection: close")
+    return b"\r\n".join(lines) + b"\r\n\r\n"
+
+def percentile(sorted_vals, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_vals:
+        return float("nan")
+    return sorted_vals[min(len(sorted_vals) - 1, int(len(sorted_vals) * pct / 100))]
+
+async def read_response(reader, head_only):
+    """Read one response, return its status, whether the server keeps the
+    connection open and the number of bytes read"""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.split(b"\r\n")
+    status = int(lines[0].split()[1])
+    length = None
+    keep_alive = lines[0].startswith(b"HTTP/1.1")
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            length = int(value)
+        elif name == b"connection":
+            keep_alive = value.strip().lower() != b"close"
+
+    if head_only or status == 304 or status < 200:
+        body = 0
+    elif length is not None:
+        body = len(await reader.readexactly(length))
+    else:
+        body = len(await reader.read())
+        keep_alive = False
+    return status, keep_alive, len(head) + body
+
+class LoadStats:
+    """Results shared by the client tasks"""
+
+    def __init__(self):
+        self.sent = 0
+        self.errors = 0
+        self.bytes = 0
+        self.connections = 0
+        self.latencies = []
+        self.statuses = dict()
+
+def make_client_context():
+    """TLS context that trusts the server's self-signed certificate"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.set_alpn_protocols(["http/1.1"])
+    return context
+
+async def client(mix, host, port, keep_alive, deadline, timeout_sec, stats, context=None):
+    """Send requests one at a time until the deadline, reusing the connection if asked"""
+    reader = writer = None
+    n = random.randrange(len(mix))
+    while time.perf_counter() < deadline:
+        request = mix[n % len(mix)]
+        n += 1
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port, ssl=context), timeout_sec)
+                stats.connections += 1
+            start = time.perf_counter()
+            writer.write(request)
+            stats.sent += 1
+            status, open_, nbytes = await asyncio.wait_for(
+                read_response(reader, request.startswith(b"HEAD ")), timeout_sec)
+            stats.latencies.append(time.perf_counter() - start)
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.bytes += nbytes
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            stats.errors += 1
+            open_ = False
+        if writer is not None and not (keep_alive and open_):
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+async def run_load(mix, host, port, concurrency, duration, keep_alive, timeout_sec, tls=False):
+    """Run the clients for the duration and collect the results"""
+    stats = LoadStats()
+    context = make_client_context() if tls else None
+    start = time.perf_counter()
+    await asyncio.gather(*(client(mix, host, port, keep_alive, start + duration, timeout_sec, stats, context)
+                           for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(stats.latencies)
+    return {
+        "sent": stats.sent,
+        "completed": len(latencies),
+        "errors": stats.errors,
+        "connections": stats.connections,
+        "rps": len(latencies) / elapsed,
+        "bps": stats.bytes / elapsed,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "p999": percentile(latencies, 99.9),
+        "statuses": stats.statuses,
+    }
+
+def print_report(results):
+    """Print throughput, latency and errors"""
+    print("Sent:        {}".format(results["sent"]))
+    print("Completed:   {}".format(results["completed"]))
+    print("Errors:      {}".format(results["errors"]))
+    print("Connections: {}".format(results["connections"]))
+    print("Throughput:  {:.0f} requests/s, {:.2f} MB/s".format(results["rps"], results["bps"] / 1e6))
+    print("Latency:     p50 {:.3f} ms, p99 {:.3f} ms, p99.9 {:.3f} ms".format(
+        results["p50"] * 1000, results["p99"] * 1000, results["p999"] * 1000))
+    print("Statuses:    {}".format(", ".join("{}: {}".format(k, v) for k, v in sorted(results["statuses"].items()))))
+
+def main(*argv):
+    """Main function"""
+    parser = argparse.ArgumentParser(prog="httpperf.py", description="HTTP load generator")
+    parser.add_argument("--host", default=ADDRESS)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="clients sending at once")
+    parser.add_argument("--duration", type=float, default=DURATION_SEC, help="seconds to send for")
+    parser.add_argument("--no-keep-alive", dest="keep_alive", action="store_false",
+                        help="open a new connection for every request")
+    parser.add_argument("--not-found-ratio", type=float, default=NOT_FOUND_RATIO,
+                        help="share of requests for a missing file")
+    parser.add_argument("--bad-method-ratio", type=float, default=BAD_METHOD_RATIO,
+                        help="share of requests with a method other than GET")
+    parser.add_argument("--replay", nargs="+", metavar="PCAPNG",
+                        help="send the requests found in these captures instead of the mix")
+    parser.add_argument("--tls", action="store_true", help="connect with TLS, for a server started with --tls")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT_SEC, help="seconds before a request fails")
+    parser.add_argument("--spawn", nargs=argparse.REMAINDER, metavar="ARG",
+                        help="start webserver.py with these extra arguments")
+    args = parser.parse_args(argv[0][1:] if argv else [])
+
+    if args.replay:
+        mix = [set_keep_alive(request, args.keep_alive)
+               for filename in args.replay for request in read_capture(filename)]
+        if not mix:
+            sys.exit("No HTTP requests found in " + ", ".join(args.replay))
+    else:
+        mix = build_request_mix(args.keep_alive, args.not_found_ratio, args.bad_method_ratio)
+
+    server = None
+    if args.spawn is not None:
+        here = os.path.dirname(os.path.abspath(__file__))
+        server = subprocess.Popen([sys.executable, os.path.join(here, "webserver.py")] + args.spawn,
+                                  cwd=here, stdout=subprocess.DEVNULL)
+        time.sleep(1)
+
+    try:
+        results = asyncio.run(run_load(mix, args.host, args.port, args.concurrency, args.duration,
+                                       args.keep_alive, args.timeout, args.tls))
+        print_report(results)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,330 @@
+"""
+Testing the Web server's request parsing, document index, negotiation and caching
+"""
+#!/usr/bin/python3
+
+
+import os
+from email.utils import formatdate
+import pytest
+from webserver import normalize_path
+from webserver import parse_request
+from webserver import parse_range
+from webserver import BadRequest
+from webserver import MAX_HEADERS
+from webserver import MAX_RANGES
+from webserver import choose_encoding
+from webserver import make_etag
+from webserver import not_modified
+from webserver import Document
+from webserver import ContentCache
+from webserver import DocumentIndex
+
+
+class TestNormalizePath:
+    """Testing request target normalization"""
+
+    def test_plain(self):
+        """Plain paths and queries come through unchanged"""
+        assert normalize_path(b"/alice30.txt") == ("/alice30.txt", "")
+        assert normalize_path(b"/a/b/?x=1&y=2") == ("/a/b/", "x=1&y=2")
+        assert normalize_path(b"/") == ("/", "")
+
+    def test_traversal(self):
+        """Dot segments never climb above the root"""
+        assert normalize_path(b"/../etc/passwd")[0] == "/etc/passwd"
+        assert normalize_path(b"/a/../../../b")[0] == "/b"
+        assert normalize_path(b"/a/./b/../c")[0] == "/a/c"
+        assert normalize_path(b"/..")[0] == "/"
+
+    def test_encoded_traversal(self):
+        """Percent-encoded dots and slashes are decoded before resolving"""
+        assert normalize_path(b"/%2e%2e/%2e%2e/etc/passwd")[0] == "/etc/passwd"
+        assert normalize_path(b"/%2E%2E%2f%2E%2E%2fetc")[0] == "/etc"
+        assert normalize_path(b"/a%2f..%2f..%2fb")[0] == "/b"
+
+    def test_slashes(self):
+        """Leading double slashes collapse, a trailing slash is kept"""
+        assert normalize_path(b"//etc/passwd")[0] == "/etc/passwd"
+        assert normalize_path(b"///a//b/")[0] == "/a/b/"
+
+    def test_bad(self):
+        """Relative targets, NULs and bad UTF-8 are rejected"""
+        for target in (b"alice30.txt", b"*", b"/a%00.txt", b"/%ff%fe"):
+            with pytest.raises(BadRequest) as info:
+                normalize_path(target)
+            assert info.value.status == "400 Bad Request"
+
+
+class TestParseRequest:
+    """Testing request head parsing"""
+
+    def test_request_line(self):
+        """Method, target, version and path"""
+        request = parse_request(b"GET /a/../alice30.txt?q HTTP/1.1\r\nHost: x")
+        assert request.method == "GET"
+        assert request.target == "/a/../alice30.txt?q"
+        assert request.version == "HTTP/1.1"
+        assert request.path == "/alice30.txt"
+        assert request.query == "q"
+
+    def test_headers(self):
+        """Names are case-insensitive, values trimmed"""
+        request = parse_request(b"GET / HTTP/1.1\r\nHOST: x\r\nuser-Agent:\t test \r\nX-Empty:")
+        assert request.headers == {"host": "x", "user-agent": "test", "x-empty": ""}
+
+    def test_duplicate_headers(self):
+        """Repeated fields are joined into one list, whatever their case"""
+        request = parse_request(b"GET / HTTP/1.1\r\nAccept: a\r\naccept: b\r\nACCEPT: c")
+        assert request.headers["accept"] == "a, b, c"
+
+    def test_too_many_headers(self):
+        """More than MAX_HEADERS fields is 431"""
+        fields = b"".join(b"\r\nX-%d: y" % i for i in range(MAX_HEADERS))
+        assert len(parse_request(b"GET / HTTP/1.1" + fields).headers) == MAX_HEADERS
+        with pytest.raises(BadRequest) as info:
+            parse_request(b"GET / HTTP/1.1" + fields + b"\r\nX-last: y")
+        assert info.value.status == "431 Request Header Fields Too Large"
+
+    def test_malformed(self):
+        """Broken request lines and header fields are 400"""
+        for head in (b"GET /", b"GET / HTTP/1.1 extra", b"GET  / HTTP/1.1",
+                     b"GET / HTTP/1.1\r\nNo colon", b"GET / HTTP/1.1\r\nBad name: x",
+                     b"GET / HTTP/1.1\r\n: x"):
+            with pytest.raises(BadRequest) as info:
+                parse_request(head)
+            assert info.value.status == "400 Bad Request"
+
+    def test_version(self):
+        """Only HTTP/1.x is served"""
+        assert parse_request(b"GET / HTTP/1.0").version == "HTTP/1.0"
+        with pytest.raises(BadRequest) as info:
+            parse_request(b"GET / HTTP/2.0")
+        assert info.value.status == "505 HTTP Version Not Supported"
+
+
+class TestParseRange:
+    """Testing Range header parsing"""
+
+    def test_ranges(self):
+        """Closed ranges, clipped to the file"""
+        assert parse_range("bytes=0-9", 100) == [(0, 10)]
+        assert parse_range("bytes=0-0, 50-59", 100) == [(0, 1), (50, 60)]
+        assert parse_range("bytes=90-200", 100) == [(90, 100)]
+
+    def test_open(self):
+        """Open-ended ranges run to the end of the file"""
+        assert parse_range("bytes=95-", 100) == [(95, 100)]
+        assert parse_range("bytes=0-", 100) == [(0, 100)]
+
+    def test_suffix(self):
+        """Suffix ranges are the last bytes of the file"""
+        assert parse_range("bytes=-10", 100) == [(90, 100)]
+        assert parse_range("bytes=-1000", 100) == [(0, 100)]
+
+    def test_unsatisfiable(self):
+        """Ranges past the end are dropped, leaving [] when none remain"""
+        assert parse_range("bytes=100-", 100) == []
+        assert parse_range("bytes=999999-", 100) == []
+        assert parse_range("bytes=100-200", 100) == []
+        assert parse_range("bytes=-0", 100) == []
+        assert parse_range("bytes=-5", 0) == []
+        assert parse_range("bytes=200-300, 0-4", 100) == [(0, 5)]
+
+    def test_ignored(self):
+        """Other units and malformed specs are ignored"""
+        for header in ("items=0-1", "bytes=5-2", "bytes=abc", "bytes=1", "bytes=-", "bytes=a-b"):
+            assert parse_range(header, 100) is None
+
+    def test_max_ranges(self):
+        """More than MAX_RANGES satisfiable ranges are ignored"""
+        spec = ",".join("{}-{}".format(i, i) for i in range(MAX_RANGES))
+        assert len(parse_range("bytes=" + spec, 100)) == MAX_RANGES
+        assert parse_range("bytes=" + spec + ",99-99", 100) is None
+        # Ranges that cannot be satisfied do not count
+        assert len(parse_range("bytes=" + spec + ",500-600", 100)) == MAX_RANGES
+
+
+class TestChooseEncoding:
+    """Testing content negotiation"""
+
+    variants = {"identity": b"", "gzip": b"", "br": b""}
+
+    def test_preference(self):
+        """Brotli before gzip, identity when nothing else is accepted"""
+        assert choose_encoding("gzip, deflate, br", self.variants) == "br"
+        assert choose_encoding("gzip", self.variants) == "gzip"
+        assert choose_encoding("GZIP;q=0.5", self.variants) == "gzip"
+        assert choose_encoding("br", {"identity": b"", "gzip": b""}) == "identity"
+        assert choose_encoding("", self.variants) == "identity"
+
+    def test_refused(self):
+        """q=0 refuses an encoding, even when * allows the others"""
+        assert choose_encoding("br;q=0, gzip", self.variants) == "gzip"
+        assert choose_encoding("br; q=0, gzip;q=0", self.variants) == "identity"
+        assert choose_encoding("*", self.variants) == "br"
+        assert choose_encoding("br;q=0, *", self.variants) == "gzip"
+        assert choose_encoding("*;q=0", self.variants) == "identity"
+        assert choose_encoding("gzip;q=x", self.variants) == "identity"
+
+
+class TestConditional:
+    """Testing ETags and conditional requests"""
+
+    @pytest.fixture(scope='function', autouse=True)
+    def setup_class(self, tmp_path):
+        """Setting up"""
+        path = tmp_path / "a.txt"
+        path.write_bytes(b"hello")
+        os.utime(path, (1000000000, 1000000000))
+        self.info = os.stat(path)
+        self.etag = make_etag(self.info, "identity")
+
+    def test_etag_per_encoding(self):
+        """Each encoding of a file has its own tag"""
+        tags = {make_etag(self.info, encoding) for encoding in ("identity", "gzip", "br")}
+        assert len(tags) == 3
+        assert make_etag(self.info, "gzip") == make_etag(self.info, "gzip")
+        assert all(tag.startswith('"') and tag.endswith('"') for tag in tags)
+
+    def test_if_none_match(self):
+        """Any listed tag, weak or not, or *, matches"""
+        assert not_modified({"if-none-match": self.etag}, self.etag, self.info)
+        assert not_modified({"if-none-match": '"x", W/' + self.etag}, self.etag, self.info)
+        assert not_modified({"if-none-match": "*"}, self.etag, self.info)
+        assert not not_modified({"if-none-match": make_etag(self.info, "gzip")}, self.etag, self.info)
+
+    def test_if_modified_since(self):
+        """Copies as new as the file are current, broken dates are not"""
+        assert not_modified({"if-modified-since": formatdate(1000000000, usegmt=True)}, self.etag, self.info)
+        assert not not_modified({"if-modified-since": formatdate(999999999, usegmt=True)}, self.etag, self.info)
+        assert not not_modified({"if-modified-since": "yesterday"}, self.etag, self.info)
+        assert not not_modified({}, self.etag, self.info)
+
+    def test_if_none_match_first(self):
+        """If-Modified-Since is ignored when If-None-Match is there"""
+        headers = {"if-none-match": '"other"', "if-modified-since": formatdate(2000000000, usegmt=True)}
+        assert not not_modified(headers, self.etag, self.info)
+
+
+class TestContentCache:
+    """Testing the document cache"""
+
+    @pytest.fixture(scope='function', autouse=True)
+    def setup_class(self, tmp_path):
+        """Setting up"""
+        self.tmp_path = tmp_path
+        self.cache = ContentCache(max_bytes=25, max_file_size=12)
+
+    def document(self, name, data, mime="application/octet-stream"):
+        path = self.tmp_path / name
+        path.write_bytes(data)
+        return Document(str(path), os.stat(path), mime)
+
+    def test_hit(self):
+        """A second get returns the same entry"""
+        doc = self.document("a", b"aaaaaaaaaa")
+        entry = self.cache.get(doc)
+        assert entry.variants == {"identity": b"aaaaaaaaaa"}
+        assert self.cache.get(doc) is entry
+        assert self.cache.size == 10
+
+    def test_lru_eviction(self):
+        """Going over max_bytes evicts the least recently used entry"""
+        a = self.document("a", b"a" * 10)
+        b = self.document("b", b"b" * 10)
+        c = self.document("c", b"c" * 10)
+        entry_a = self.cache.get(a)
+        self.cache.get(b)
+        self.cache.get(a)              # b is now the oldest
+        self.cache.get(c)
+        assert list(self.cache.entries) == [a.path, c.path]
+        assert self.cache.size == 20
+        assert self.cache.get(a) is entry_a
+
+    def test_stamp_invalidation(self):
+        """An entry is reread once the index sees its file change"""
+        doc = self.document("a", b"old")
+        assert self.cache.get(doc).variants["identity"] == b"old"
+        changed = self.document("a", b"newer")
+        assert self.cache.get(changed).variants["identity"] == b"newer"
+        assert list(self.cache.entries) == [doc.path]
+        assert self.cache.size == 5
+
+    def test_too_large(self):
+        """Files past max_file_size are not read into memory"""
+        assert self.cache.get(self.document("big", b"x" * 13)) is None
+        assert self.cache.size == 0
+
+    def test_compress(self):
+        """Compressed variants are added later and counted in the size"""
+        self.cache = ContentCache(max_bytes=1000, max_file_size=1000)
+        doc = self.document("a.txt", b"a" * 500, "text/plain")
+        entry = self.cache.get(doc)
+        assert list(entry.variants) == ["identity"]
+        self.cache.compress(doc.path, entry)
+        assert "gzip" in entry.variants
+        assert self.cache.size == entry.size == sum(len(body) for body in entry.variants.values())
+
+
+class TestDocumentIndex:
+    """Testing the index of the document root"""
+
+    @pytest.fixture(scope='function', autouse=True)
+    def setup_class(self, tmp_path):
+        """Setting up"""
+        root = tmp_path / "www"
+        (root / "dir" / "sub").mkdir(parents=True)
+        (root / "a.txt").write_text("a")
+        (root / "dir" / "index.html").write_text("<html></html>")
+        (root / ".hidden").write_text("secret")
+        (root / "dir" / ".git").mkdir()
+        (root / "dir" / ".git" / "config").write_text("secret")
+        (tmp_path / "outside.txt").write_text("secret")
+        os.symlink(tmp_path / "outside.txt", root / "link.txt")
+        os.symlink(tmp_path, root / "up")
+        for name in ("webserver.crt", "webserver.key", "webserver.log", "webserver.log.1", "webserver.logs"):
+            (root / name).write_text("x")
+        self.root = root
+        self.index = DocumentIndex(str(root), 0, private=[str(root / name) for name in
+                                                          ("webserver.crt", "webserver.key", "webserver.log")])
+        self.index.refresh()
+
+    def test_files(self):
+        """Files are found by request path, with their type"""
+        doc = self.index.lookup("/a.txt")
+        assert doc.path == str(self.root / "a.txt")
+        assert doc.mime.startswith("text/plain")
+        assert self.index.lookup("/missing.txt") is None
+
+    def test_directory_index(self):
+        """A directory with a trailing slash serves its index.html"""
+        assert self.index.lookup("/dir/").path == str(self.root / "dir" / "index.html")
+        assert self.index.lookup("/dir/index.html") is self.index.lookup("/dir/")
+        assert self.index.lookup("/dir/sub/") is None
+
+    def test_redirect(self):
+        """A directory without its trailing slash gives the path to redirect to"""
+        assert self.index.lookup("/dir") == "/dir/"
+        assert self.index.lookup("/dir/sub") == "/dir/sub/"
+
+    def test_hidden_and_symlinks(self):
+        """Hidden entries and symbolic links are never served"""
+        for path in ("/.hidden", "/dir/.git", "/dir/.git/config", "/link.txt", "/up", "/up/outside.txt"):
+            assert self.index.lookup(path) is None
+
+    def test_private(self):
+        """The certificate, key and log, rotated copies included, are left out"""
+        for name in ("webserver.crt", "webserver.key", "webserver.log", "webserver.log.1"):
+            assert self.index.is_private(str(self.root / name))
+            assert self.index.lookup("/" + name) is None
+        assert not self.index.is_private(str(self.root / "webserver.logs"))
+        assert self.index.lookup("/webserver.logs") is not None
+
+    def test_rescan(self):
+        """A rescan picks up new files and drops removed ones"""
+        (self.root / "b.txt").write_text("b")
+        (self.root / "a.txt").unlink()
+        self.index.refresh()
+        assert self.index.lookup("/b.txt") is not None
+        assert self.index.lookup("/a.txt") is None
@@ -1,96 +1,1229 @@
 """Python Web server implementation"""
-from socket import socket, AF_INET, SOCK_STREAM
+import argparse
+import gzip
+import os
+import posixpath
+import re
+import selectors
+import signal
+import ssl
+import stat
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from socket import socket, socketpair, timeout, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+from queue import Queue, Empty, Full
+from threading import Event, Lock, Thread
+from urllib.parse import unquote_to_bytes
 
-server = socket(AF_INET, SOCK_STREAM)
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 ADDRESS = "127.0.0.2"  # Local client is going to be 127.0.0.1
 PORT = 4300  # Open http://127.0.0.2:4300 in a browser
 LOGFILE = "webserver.log"
+LOG_FORMAT = "{time} | {path} | {ip} | {agent}"
+LOG_QUEUE = 10000          # Records waiting for the writer before new ones are dropped
+LOG_BATCH = 256            # Most records formatted into one write
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+MODES = ("select", "thread", "prefork")
+BACKLOG = 128
+MAX_CONNECTIONS = 256
+WORKERS = 8
+RECV_SIZE = 4096
+CHUNK_SIZE = 2048
+TLS_CHUNK_SIZE = 16384     # One TLS record
+CERTFILE = "webserver.crt"
+KEYFILE = "webserver.key"
+ALPN_PROTOCOLS = ["http/1.1"]
+TLS_TICKETS = 2            # Session tickets handed to each TLS 1.3 client
+MAX_HEADER_SIZE = 8192
+MAX_HEADERS = 100
+IDLE_TIMEOUT = 15
+DOCROOT = "www"            # Kept apart from the code, certificate and logs
+INDEX_FILE = "index.html"
+INDEX_REFRESH_SEC = 5
+CACHE_SIZE = 64 * 1024 * 1024       # Bytes of file contents and variants held in memory
+CACHE_FILE_SIZE = 4 * 1024 * 1024   # Larger files are sent from disk with sendfile
+TEXT_TYPE = "text/plain; charset=utf-8"
+DEFAULT_TYPE = "application/octet-stream"
+MIME_TYPES = {
+    ".txt": TEXT_TYPE,
+    ".html": "text/html; charset=utf-8",
+    ".htm": "text/html; charset=utf-8",
+    ".css": "text/css; charset=utf-8",
+    ".csv": "text/csv; charset=utf-8",
+    ".md": "text/markdown; charset=utf-8",
+    ".js": "application/javascript; charset=utf-8",
+    ".json": "application/json",
+    ".xml": "application/xml",
+    ".svg": "image/svg+xml",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".ico": "image/x-icon",
+    ".webp": "image/webp",
+    ".pdf": "application/pdf",
+    ".zip": "application/zip",
+    ".gz": "application/gzip",
+    ".mp3": "audio/mpeg",
+    ".mp4": "video/mp4",
+    ".woff2": "font/woff2",
+    ".pcapng": "application/vnd.tcpdump.pcap",
+}
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+MAX_RANGES = 16            # More ranges than this in one request are ignored
+WOULD_BLOCK = (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+CONTENT_LENGTH = re.compile(rb"\r\ncontent-length:[ \t]*(\d+)", re.IGNORECASE)
+REQUEST_LINE = re.compile(rb"([!#$%&'*+.^_`|~0-9A-Za-z-]+) (\S+) HTTP/(\d)\.(\d)")
+HEADER_NAME = re.compile(rb"[!#$%&'*+.^_`|~0-9A-Za-z-]+")
 
-def writeToLog(time, recFile, ip, browser, log=LOGFILE):
-    with open(log,"a") as f:
-        output = time+" | "+recFile+" | "+ip+" | "+browser+"\n"
-        f.write(output)
+class AccessLog:
+    """Write access log records from a background thread, in batches,
+    rotating the file once it grows past max_bytes"""
 
-def main():
-    """Main loop"""
+    def __init__(self, filename=LOGFILE, line_format=LOG_FORMAT,
+                 max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.filename = filename
+        self.line_format = line_format
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = Queue(LOG_QUEUE)
+        self.dropped = 0
+        self.thread = None
+        self.file = None
+
+    def log(self, **record):
+        """Queue a record without ever waiting on the writer"""
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def start(self):
+        """Start the writer, in the process that will be logging"""
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """Write out the records still queued and stop the writer"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            records = [self.queue.get()]
+            try:
+                while len(records) < LOG_BATCH:
+                    records.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            done = records[-1] is None
+            lines = "".join(self.format(record) for record in records if record is not None)
+            if self.dropped:
+                lines += "-- {} records dropped --\n".format(self.dropped)
+                self.dropped = 0
+            try:
+                self.write(lines)
+            except OSError as e:
+                print("  Logging Failed:- {!r}".format(e))
+            if done:
+                if self.file is not None:
+                    self.file.close()
+                return
+
+    def format(self, record):
+        try:
+            return self.line_format.format(**record) + "\n"
+        except (KeyError, IndexError, ValueError):
+            return " | ".join(str(value) for value in record.values()) + "\n"
+
+    def write(self, lines):
+        if self.file is not None:
+            try:
+                current = os.stat(self.filename).st_ino == os.fstat(self.file.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if not current:            # Another process rotated it
+                self.file.close()
+                self.file = None
+        if self.file is None:
+            self.file = open(self.filename, "a")
+        self.file.write(lines)
+        self.file.flush()
+        if self.max_bytes and self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        """Shift webserver.log to webserver.log.1 and so on, dropping the oldest"""
+        self.file.close()
+        self.file = None
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists("{}.{}".format(self.filename, n)):
+                os.replace("{}.{}".format(self.filename, n), "{}.{}".format(self.filename, n + 1))
+        if self.backups:
+            os.replace(self.filename, self.filename + ".1")
+        else:
+            os.remove(self.filename)
+
+ACCESS_LOG = AccessLog()
+
+def make_certificate(certfile=CERTFILE, keyfile=KEYFILE):
+    """Write a self-signed certificate for ADDRESS, for local testing"""
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "365",
+                    "-subj", "/CN=" + ADDRESS, "-addext", "subjectAltName=IP:" + ADDRESS,
+                    "-keyout", keyfile, "-out", certfile],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def make_tls_context(certfile=CERTFILE, keyfile=KEYFILE):
+    """Server context offering ALPN and session resumption, by session ID for
+    TLS 1.2 and by ticket for TLS 1.3"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.set_alpn_protocols(ALPN_PROTOCOLS)
+    context.num_tickets = TLS_TICKETS
+    return context
+
+def tls_summary(conn):
+    return "  TLS:- {} {} alpn={} resumed={}".format(
+        conn.version(), conn.cipher()[0], conn.selected_alpn_protocol(), conn.session_reused)
+
+def make_server(backlog=BACKLOG):
+    """Create the listening socket"""
+    server = socket(AF_INET, SOCK_STREAM)
+    server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
     server.bind((ADDRESS, PORT))
-    server.listen(1)
+    server.listen(backlog)
+    return server
+
+class FileRegion:
+    """A byte range of an open file, to be sent with sendfile"""
+    __slots__ = ("file", "offset", "count")
+
+    def __init__(self, file, offset, count):
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+def read_chunks(f):
+    """Yield a file that sendfile cannot handle in CHUNK_SIZE pieces of one reused buffer"""
+    buf = memoryview(bytearray(CHUNK_SIZE))
+    nbytes = f.readinto(buf)
+    while nbytes:
+        yield buf[:nbytes]     # Sent before the next read overwrites it
+        nbytes = f.readinto(buf)
+
+class RequestReader:
+    """Collect the bytes of a connection and split them into requests"""
+    __slots__ = ("buf", "skip")
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.skip = 0          # Body bytes of the last request still to discard
+
+    def feed(self, data):
+        self.buf += data
+
+    def next_request(self):
+        """Return the head of the next complete request, or None until more data arrives"""
+        if self.skip:
+            nbytes = min(self.skip, len(self.buf))
+            del self.buf[:nbytes]
+            self.skip -= nbytes
+            if self.skip:
+                return None
+        while self.buf.startswith(b"\r\n"):      # Stray line breaks between requests
+            del self.buf[:2]
+
+        end = self.buf.find(b"\r\n\r\n", 0, MAX_HEADER_SIZE)
+        if end < 0:
+            if len(self.buf) >= MAX_HEADER_SIZE:
+                raise ValueError("Request header larger than {} bytes".format(MAX_HEADER_SIZE))
+            return None
+        head = bytes(self.buf[:end])
+        del self.buf[:end + 4]
+        match = CONTENT_LENGTH.search(head)
+        if match:
+            self.skip = int(match.group(1))
+        return head
+
+def mime_type(name):
+    return MIME_TYPES.get(os.path.splitext(name)[1].lower(), DEFAULT_TYPE)
+
+class Document:
+    """A file under the document root as the index last saw it"""
+    __slots__ = ("path", "info", "mime")
+
+    def __init__(self, path, info, mime):
+        self.path = path
+        self.info = info
+        self.mime = mime
+
+class DocumentIndex:
+    """Request paths of the files under a document root, rescanned in the
+    background so that requests never stat the filesystem"""
+
+    def __init__(self, root=DOCROOT, refresh_sec=INDEX_REFRESH_SEC, private=()):
+        self.root = root
+        self.refresh_sec = refresh_sec
+        # The server's own files, and their rotated copies, are never served
+        # even if the root is set to the directory holding them
+        self.private = tuple(os.path.realpath(path) for path in private)
+        self.paths = dict()
+        self.stopped = Event()
+        self.thread = None
+
+    def lookup(self, path):
+        """Document for a request path, the path to redirect to for a directory
+        named without its trailing slash, or None"""
+        return self.paths.get(path)
+
+    def refresh(self):
+        """Rescan the root, swapping the new paths in whole so that readers
+        never see half a scan"""
+        paths = dict()
+        directories = [(self.root, "/")]
+        while directories:
+            directory, prefix = directories.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith(".") or entry.is_symlink():
+                    continue           # Nothing outside the root, nothing hidden
+                if self.is_private(entry.path):
+                    continue
+                name = prefix + entry.name
+                try:
+                    if entry.is_dir():
+                        paths[name] = name + "/"
+                        directories.append((entry.path, name + "/"))
+                    elif entry.is_file():
+                        paths[name] = Document(entry.path, entry.stat(), mime_type(entry.name))
+                except OSError:
+                    continue
+            index = paths.get(prefix + INDEX_FILE)
+            if isinstance(index, Document):
+                paths[prefix] = index
+        self.paths = paths
+
+    def is_private(self, path):
+        path = os.path.realpath(path)
+        return any(path == private or path.startswith(private + ".") for private in self.private)
+
+    def start(self):
+        """Start rescanning, in the process that will be serving"""
+        if self.refresh_sec > 0:
+            self.stopped.clear()
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.refresh_sec):
+            self.refresh()
+
+INDEX = DocumentIndex()
+
+class CachedFile:
+    """Contents of a file read into memory along with its compressed variants,
+    which are added later by the cache's compressor thread"""
+    __slots__ = ("info", "stamp", "variants", "size", "compressible")
+
+    def __init__(self, f, mime):
+        self.info = os.fstat(f.fileno())
+        self.stamp = None
+        data = f.read()
+        self.variants = {"identity": data}
+        self.size = len(data)
+        self.compressible = mime.startswith(COMPRESSIBLE)
+
+    def compress(self):
+        """The variants with the compressed ones added, to be swapped in whole"""
+        data = self.variants["identity"]
+        compressed = {"gzip": gzip.compress(data, 9)}
+        if brotli is not None:
+            compressed["br"] = brotli.compress(data)
+        variants = {"identity": data}
+        for encoding, body in compressed.items():
+            if len(body) < len(data):      # Compressing does not always pay
+                variants[encoding] = body
+        return variants
+
+class ContentCache:
+    """Size-bounded LRU cache of documents, dropping entries once the index
+    sees their file change; compressing is left to a background thread so
+    that a miss costs a request no more than reading the file"""
+
+    def __init__(self, max_bytes=CACHE_SIZE, max_file_size=CACHE_FILE_SIZE):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self.pending = Queue()         # (path, entry) waiting to be compressed
+        self.thread = None
+
+    def start(self):
+        """Start the compressor, in the process that will be serving"""
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.pending.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            self.compress(*item)
+
+    def compress(self, path, entry):
+        """Add the compressed variants to an entry; until then it is sent as is"""
+        variants = entry.compress()
+        size = sum(len(body) for body in variants.values())
+        with self.lock:
+            entry.variants = variants
+            if self.entries.get(path) is entry:
+                self.size += size - entry.size
+            entry.size = size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+
+    def get(self, doc):
+        """Return the CachedFile for a document, or None when it is too large
+        to hold in memory"""
+        stamp = (doc.info.st_mtime_ns, doc.info.st_size)
+        with self.lock:
+            entry = self.entries.get(doc.path)
+            if entry is not None:
+                if entry.stamp == stamp:
+                    self.entries.move_to_end(doc.path)
+                    return entry
+                del self.entries[doc.path]
+                self.size -= entry.size
+        if doc.info.st_size > self.max_file_size:
+            return None
+
+        with open(doc.path, "rb") as f:    # Read outside the lock
+            entry = CachedFile(f, doc.mime)
+        entry.stamp = stamp
+        if entry.size > self.max_bytes:
+            return entry
+        with self.lock:
+            old = self.entries.pop(doc.path, None)
+            if old is not None:
+                self.size -= old.size
+            self.entries[doc.path] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted.size
+        if entry.compressible and self.thread is not None:
+            self.pending.put((doc.path, entry))
+        return entry
+
+CACHE = ContentCache()
+
+def respond(*parts):
+    """Response made of fixed parts"""
+    yield from parts
+
+def send_part(conn, part):
+    """Send part of a response on a blocking socket"""
+    if isinstance(part, FileRegion):
+        conn.sendfile(part.file, part.offset, part.count)
+    else:
+        conn.sendall(part)
+
+class BadRequest(ValueError):
+    """A request head that cannot be answered, with the status to answer it with"""
+
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+
+class Request:
+    """Request line and headers; header names are lowercased"""
+    __slots__ = ("method", "target", "path", "query", "version", "headers")
+
+def normalize_path(target):
+    """Percent-decode the path of a request target and resolve its dot
+    segments, never climbing above the root"""
+    path, _, query = target.partition(b"?")
+    if not path.startswith(b"/"):
+        raise BadRequest("400 Bad Request", "Target is not an absolute path")
+    try:
+        path = unquote_to_bytes(path).decode("utf-8")
+    except UnicodeDecodeError:
+        raise BadRequest("400 Bad Request", "Path is not UTF-8") from None
+    if "\x00" in path:
+        raise BadRequest("400 Bad Request", "NUL in path")
+    normal = posixpath.normpath(path)
+    if normal.startswith("//"):        # normpath keeps a leading double slash
+        normal = "/" + normal.lstrip("/")
+    if path.endswith("/") and normal != "/":
+        normal += "/"
+    return normal, query.decode("latin-1")
+
+def parse_request(head):
+    """Parse a request head from its bytes, without the final blank line"""
+    lines = head.split(b"\r\n", MAX_HEADERS + 1)
+    if len(lines) > MAX_HEADERS + 1:
+        raise BadRequest("431 Request Header Fields Too Large", "Too many header fields")
+    match = REQUEST_LINE.fullmatch(lines[0])
+    if match is None:
+        raise BadRequest("400 Bad Request", "Malformed request line")
+    if match.group(3) != b"1":
+        raise BadRequest("505 HTTP Version Not Supported", "Unsupported version")
+
+    request = Request()
+    request.method = match.group(1).decode("ascii")
+    request.target = match.group(2).decode("latin-1")
+    request.version = "HTTP/{}.{}".format(match.group(3).decode(), match.group(4).decode())
+    request.path, request.query = normalize_path(match.group(2))
+
+    headers = {}
+    for line in lines[1:]:
+        name, colon, value = line.partition(b":")
+        if not colon or HEADER_NAME.fullmatch(name) is None:
+            raise BadRequest("400 Bad Request", "Malformed header field")
+        name = name.decode("ascii").lower()
+        value = value.strip(b" \t").decode("latin-1")
+        if name in headers:
+            headers[name] += ", " + value      # Repeated fields form one list
+        else:
+            headers[name] = value
+    request.headers = headers
+    return request
+
+def connection_header(keep_alive):
+    return "Connection: keep-alive\r\n" if keep_alive else "Connection: close\r\n"
+
+def wants_keep_alive(version, headers):
+    """HTTP/1.1 connections stay open unless closed, HTTP/1.0 ones only when asked"""
+    options = [option.strip() for option in headers.get("connection", "").lower().split(",")]
+    if version == "HTTP/1.0":
+        return "keep-alive" in options
+    return "close" not in options
 
-    while True:
-        conn, addr = server.accept()
-        print("Accepted Connection:- {}".format(addr[0]+":"+str(addr[1])))
-        with conn:
-            data = conn.recv(1024)
-            dataStr = data.decode()
-            lines = dataStr.split("\r\n")
+def error_response(status, keep_alive, extra=""):
+    """Response with a small HTML body naming the status"""
+    body = "<html><head></head><body><h1>" + status + "</h1></body></html>"
+    header = "HTTP/1.1 " + status + "\r\n"
+    header += "Content-Length: " + str(len(body)) + "\r\n"
+    header += "Content-Type: text/html\r\n"
+    header += extra
+    header += connection_header(keep_alive) + "\r\n"
+    return respond(header.encode(), body.encode())
 
-            print("  Parsing Request")
+def handle_request(data, addr):
+    """Parse a request head, log it and return a generator of the response parts
+    and whether the connection stays open after it"""
+    print("  Parsing Request")
+    now = str(datetime.now())
+    try:
+        request = parse_request(data)
+    except BadRequest as e:
+        print("    Bad Request:- {}".format(e))
+        return error_response(e.status, False), False
+    print("  Parsing Complete")
 
-            reqDict = {"Time":str(datetime.now())}
+    print("  Logging Request")
+    headers = request.headers
+    ACCESS_LOG.log(time=now, method=request.method, path=request.target, version=request.version,
+                   ip=addr[0], agent=headers.get("user-agent", "-"))
+    keep_alive = wants_keep_alive(request.version, headers)
 
-            # Loop-and-a-half
-            line1 = lines[0].split()
-            if len(line1) == 3:
-                method, reqFile, version = line1
+    # Method Not Allowed
+    if request.method != "GET":
+        print("    Invalid Method:- "+request.method)
+        return error_response("405 Method Not Allowed", keep_alive), keep_alive
+
+    # File Not Found
+    doc = INDEX.lookup(request.path)
+    if doc is None:
+        print("    File Not Found:- "+request.path)
+        return error_response("404 Not Found", keep_alive), keep_alive
+
+    # Directory named without its trailing slash
+    if isinstance(doc, str):
+        print("    Redirecting:- "+doc)
+        return error_response("301 Moved Permanently", keep_alive, "Location: " + doc + "\r\n"), keep_alive
+
+    # Fulfill Request
+    print("  Responding")
+    try:
+        return send_file(doc, headers, keep_alive)
+    except FileNotFoundError:          # Removed since the index last looked
+        print("    File Not Found:- "+request.path)
+        return error_response("404 Not Found", keep_alive), keep_alive
+
+def choose_encoding(accept, variants):
+    """Pick the smallest variant the Accept-Encoding header allows; q=0
+    refuses an encoding even when * allows the rest"""
+    allowed = set()
+    refused = set()
+    for item in accept.split(","):
+        token, _, params = item.strip().partition(";")
+        token = token.strip().lower()
+        params = params.replace(" ", "")
+        try:
+            if params.startswith("q=") and float(params[2:]) == 0:
+                refused.add(token)
+                continue
+        except ValueError:
+            continue
+        allowed.add(token)
+    for encoding in ("br", "gzip"):
+        if encoding in variants and encoding not in refused and (encoding in allowed or "*" in allowed):
+            return encoding
+    return "identity"
+
+def make_etag(info, encoding):
+    tag = "{:x}-{:x}".format(info.st_mtime_ns, info.st_size)
+    if encoding != "identity":
+        tag += "-" + encoding        # Each representation needs its own tag
+    return '"' + tag + '"'
+
+def not_modified(headers, etag, info):
+    """Whether the client's copy is current, If-None-Match taking precedence"""
+    if "if-none-match" in headers:
+        tags = [t.strip() for t in headers["if-none-match"].split(",")]
+        return "*" in tags or etag in [t[2:] if t.startswith("W/") else t for t in tags]
+    if "if-modified-since" in headers:
+        try:
+            since = parsedate_to_datetime(headers["if-modified-since"])
+        except (TypeError, ValueError):
+            return False
+        return int(info.st_mtime) <= since.timestamp()
+    return False
+
+def file_header(status, info, etag, encoding, length, keep_alive, content_type=TEXT_TYPE, extra=""):
+    header = "HTTP/1.1 " + status + "\r\n"
+    if length is not None:
+        header += "Content-Length: " + str(length) + "\r\n"
+    header += "Content-Type: " + content_type + "\r\n"
+    header += extra
+    if encoding != "identity":
+        header += "Content-Encoding: " + encoding + "\r\n"
+    header += "Date: " + formatdate(usegmt=True) + "\r\n"
+    header += "Last-Modified: " + formatdate(info.st_mtime, usegmt=True) + "\r\n"
+    header += "ETag: " + etag + "\r\n"
+    header += "Vary: Accept-Encoding\r\n"
+    header += "Accept-Ranges: bytes\r\n"
+    header += "Server: CS430-TCONZ\r\n"
+    header += connection_header(keep_alive) + "\r\n"
+    return header.encode()
+
+def parse_range(header, size):
+    """(start, stop) pairs of a Range header, [] when none of them can be
+    satisfied, or None when the header is to be ignored"""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for item in spec.split(","):
+        first, dash, last = item.strip().partition("-")
+        if not dash:
+            return None
+        try:
+            if first:
+                start = int(first)
+                stop = int(last) + 1 if last else max(size, start + 1)
+                if start < 0 or stop <= start:
+                    return None
+            else:
+                suffix = int(last)     # The last bytes of the file
+                if suffix <= 0:
+                    continue
+                start, stop = max(size - suffix, 0), size
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, min(stop, size)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+def if_range_matches(headers, etag, info):
+    """Whether the representation If-Range names is still the current one"""
+    value = headers["if-range"].strip()
+    if value.startswith('"') or value.startswith("W/"):
+        return value == etag           # Weak tags never match
+    try:
+        return int(info.st_mtime) == parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+def range_parts(headers, info, etag, keep_alive, content_type, region):
+    """Parts of a 206 or 416 response to the Range header, or None to send the
+    whole file; region(start, stop) gives the body of one range"""
+    if "range" not in headers or not stat.S_ISREG(info.st_mode):
+        return None
+    if "if-range" in headers and not if_range_matches(headers, etag, info):
+        return None
+    ranges = parse_range(headers["range"], info.st_size)
+    if ranges is None:
+        return None
+
+    if not ranges:
+        return [file_header("416 Range Not Satisfiable", info, etag, "identity", 0, keep_alive, content_type,
+                            extra="Content-Range: bytes */{}\r\n".format(info.st_size))]
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        return [file_header("206 Partial Content", info, etag, "identity", stop - start, keep_alive, content_type,
+                            extra="Content-Range: bytes {}-{}/{}\r\n".format(start, stop - 1, info.st_size)),
+                region(start, stop)]
+
+    boundary = os.urandom(12).hex()
+    heads = [("\r\n--" + boundary + "\r\nContent-Type: " + content_type + "\r\n"
+              "Content-Range: bytes {}-{}/{}\r\n\r\n".format(start, stop - 1, info.st_size)).encode()
+             for start, stop in ranges]
+    tail = ("\r\n--" + boundary + "--\r\n").encode()
+    length = sum(map(len, heads)) + sum(stop - start for start, stop in ranges) + len(tail)
+    parts = [file_header("206 Partial Content", info, etag, "identity", length, keep_alive,
+                         content_type="multipart/byteranges; boundary=" + boundary)]
+    for head, (start, stop) in zip(heads, ranges):
+        parts.append(head)
+        parts.append(region(start, stop))
+    parts.append(tail)
+    return parts
+
+def send_file(doc, headers, keep_alive):
+    """Response carrying a document, from the cache when it fits and otherwise
+    from disk with sendfile; 304 when the client's copy is current and 206
+    for the ranges it asks for"""
+    entry = CACHE.get(doc)
+    if entry is None:
+        return send_uncached(doc.path, doc.mime, headers, keep_alive)
+
+    variants = entry.variants          # Read once, the compressor may swap in more
+    if "range" in headers:
+        encoding = "identity"          # Ranges are served from the plain bytes
+    else:
+        encoding = choose_encoding(headers.get("accept-encoding", ""), variants)
+    etag = make_etag(entry.info, encoding)
+    if not_modified(headers, etag, entry.info):
+        return respond(file_header("304 Not Modified", entry.info, etag, encoding, None, keep_alive, doc.mime)), keep_alive
+    body = variants[encoding]
+    parts = range_parts(headers, entry.info, etag, keep_alive, doc.mime,
+                        lambda start, stop: memoryview(body)[start:stop])
+    if parts is not None:
+        return respond(*parts), keep_alive
+    return respond(file_header("200 OK", entry.info, etag, encoding, len(body), keep_alive, doc.mime), body), keep_alive
+
+def send_uncached(path, content_type, headers, keep_alive):
+    f = open(path,"rb")
+    try:
+        info = os.fstat(f.fileno())
+    except OSError:
+        f.close()
+        raise
+    etag = make_etag(info, "identity")
+    if not_modified(headers, etag, info):
+        f.close()
+        return respond(file_header("304 Not Modified", info, etag, "identity", None, keep_alive, content_type)), keep_alive
+    parts = range_parts(headers, info, etag, keep_alive, content_type,
+                        lambda start, stop: FileRegion(f, start, stop - start))
+    if parts is not None:
+        return region_parts(f, parts), keep_alive
+    # Without a Content-Length only closing the connection ends the body
+    keep_alive = keep_alive and stat.S_ISREG(info.st_mode)
+    return file_parts(f, info, etag, keep_alive, content_type), keep_alive
+
+def region_parts(f, parts):
+    with f:
+        yield from parts
+
+def file_parts(f, info, etag, keep_alive, content_type):
+    with f:
+        length = info.st_size if stat.S_ISREG(info.st_mode) else None
+        yield file_header("200 OK", info, etag, "identity", length, keep_alive, content_type)
+
+        if stat.S_ISREG(info.st_mode):
+            yield FileRegion(f, 0, info.st_size)
+        else:
+            yield from read_chunks(f)
+
+def serve_requests(conn, addr, reader, ready=True):
+    """Answer the requests on a blocking connection in order, reading first if
+    it is ready; return True once the client is between requests, so that the
+    connection can wait for the next one in a selector rather than on a
+    worker, or False once it is closed"""
+    try:
+        keep_alive = True
+        while keep_alive:
+            try:
+                head = reader.next_request()
+            except ValueError:
+                parts, keep_alive = error_response("431 Request Header Fields Too Large", False), False
             else:
-                method, version = line1
-                reqFile = None
+                if head is None:
+                    if not ready and not reader.buf and not reader.skip and not (
+                            isinstance(conn, ssl.SSLSocket) and conn.pending()):
+                        return True
+                    data = conn.recv(RECV_SIZE)     # Or the rest of a request already started
+                    if not data:
+                        break
+                    reader.feed(data)
+                    ready = False
+                    continue
+                parts, keep_alive = handle_request(head, addr)
+            for part in parts:
+                send_part(conn, part)
+    except timeout:
+        print("  Idle Timeout")
+    except Exception as e:
+        print("  Request Failed:- {!r}".format(e))
+    return False
+
+
+class Connection:
+    """State of one client in the event loop or the dispatcher"""
+    __slots__ = ("conn", "addr", "handshaking", "reader", "parts", "pending", "keep_alive", "last_active")
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.handshaking = isinstance(conn, ssl.SSLSocket)
+        self.reader = RequestReader()
+        self.parts = None      # Generator of the response being sent
+        self.pending = b""     # Bytes or FileRegion the socket has not taken yet
+        self.keep_alive = True
+        self.last_active = time.monotonic()
+
+
+class EventLoopServer:
+    """Serve every connection from one thread with selectors"""
+
+    def __init__(self, server, max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT, context=None):
+        self.server = server
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.context = context
+        self.selector = selectors.DefaultSelector()
+        self.connections = 0
+        self.accepting = False
+
+    def run(self):
+        self.server.setblocking(False)
+        self.resume_accepting()
+        swept = time.monotonic()
+        while True:
+            for key, events in self.selector.select(1):
+                if key.data is None:
+                    self.accept()
+                elif key.data.handshaking:
+                    self.handshake(key.data)
+                elif events & selectors.EVENT_READ:
+                    self.read(key.data)
+                else:
+                    self.write(key.data)
+            now = time.monotonic()
+            if now - swept >= 1:
+                self.close_idle(now)
+                swept = now
+
+    def close_idle(self, now):
+        """Close connections that have waited too long for their next request"""
+        for key in list(self.selector.get_map().values()):
+            client = key.data
+            if client is not None and client.parts is None and now - client.last_active > self.idle_timeout:
+                print("  Idle Timeout")
+                self.close(client)
 
-            reqDict["Method"] = method
-            reqDict["ReqFile"] = reqFile
-            reqDict["Version"] = version
+    def resume_accepting(self):
+        if not self.accepting:
+            self.selector.register(self.server, selectors.EVENT_READ)
+            self.accepting = True
 
-            for l in lines[1:]:
-                sl = l.split(": ")
-                if len(sl) == 2:
-                    reqDict[sl[0]] = sl[1]
+    def pause_accepting(self):
+        if self.accepting:
+            self.selector.unregister(self.server)
+            self.accepting = False
 
-            print("  Parsing Complete")
+    def accept(self):
+        while self.connections < self.max_connections:
+            try:
+                conn, addr = self.server.accept()
+            except BlockingIOError:
+                return
+            print("Accepted Connection:- {}".format(addr[0]+":"+str(addr[1])))
+            conn.setblocking(False)
+            if self.context is not None:
+                conn = self.context.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
+            self.selector.register(conn, selectors.EVENT_READ, Connection(conn, addr))
+            self.connections += 1
+        self.pause_accepting()     # Leave the rest in the backlog until a connection closes
 
-            print("  Logging Request")
-            writeToLog(reqDict["Time"],reqDict["ReqFile"],addr[0],reqDict["User-Agent"])
+    def handshake(self, client):
+        """Take the TLS handshake one step further without blocking"""
+        try:
+            client.conn.do_handshake()
+        except ssl.SSLWantReadError:
+            self.selector.modify(client.conn, selectors.EVENT_READ, client)
+            return
+        except ssl.SSLWantWriteError:
+            self.selector.modify(client.conn, selectors.EVENT_WRITE, client)
+            return
+        except (ssl.SSLError, OSError) as e:
+            print("  Handshake Failed:- {!r}".format(e))
+            self.close(client)
+            return
+        print(tls_summary(client.conn))
+        client.handshaking = False
+        self.selector.modify(client.conn, selectors.EVENT_READ, client)
+        self.read(client)              # The request may have come in with the handshake
 
-            # Method Not Allowed
-            if reqDict["Method"] != "GET":
-                print("    Invalid Method:- "+reqDict["Method"])
-                conn.send("HTTP/1.1 405 Method Not Allowed\r\n\r\n".encode())
-                conn.send("<html><head></head><body><h1>405 Method Not Allowed</h1></body></html>".encode())
+    def read(self, client):
+        try:
+            data = client.conn.recv(RECV_SIZE)
+            if not data:
+                self.close(client)
+                return
+            client.reader.feed(data)
+            if isinstance(client.conn, ssl.SSLSocket):
+                # Decrypted bytes left in the TLS buffer never make the socket readable
+                while client.conn.pending():
+                    client.reader.feed(client.conn.recv(client.conn.pending()))
+            client.last_active = time.monotonic()
+            if self.next_response(client):
+                self.write(client)
+        except WOULD_BLOCK:
+            return
+        except Exception as e:
+            print("  Request Failed:- {!r}".format(e))
+            self.close(client)
 
-            # File Not Found
-            elif reqDict["ReqFile"] != "/alice30.txt":
-                print("    File Not Found:- "+reqDict["ReqFile"])
-                conn.send("HTTP/1.1 404 Not Found\r\n\r\n".encode())
-                conn.send("<html><head></head><body><h1>404 Not Found</h1></body></html>".encode())
+    def next_response(self, client):
+        """Start on the next pipelined request, or wait for more of it"""
+        try:
+            head = client.reader.next_request()
+        except ValueError:
+            client.parts = error_response("431 Request Header Fields Too Large", False)
+            client.keep_alive = False
+        else:
+            if head is None:
+                self.selector.modify(client.conn, selectors.EVENT_READ, client)
+                return False
+            client.parts, client.keep_alive = handle_request(head, client.addr)
+        self.selector.modify(client.conn, selectors.EVENT_WRITE, client)
+        return True
 
-            # Fulfill Request
+    def write(self, client):
+        try:
+            while True:
+                if not client.pending:
+                    client.pending = next(client.parts, None)
+                    if client.pending is None:
+                        client.parts = None
+                        client.pending = b""
+                        client.last_active = time.monotonic()
+                        if not client.keep_alive:
+                            self.close(client)
+                            return
+                        if not self.next_response(client):
+                            return
+                        continue
+                pending = client.pending
+                if isinstance(pending, FileRegion):
+                    if isinstance(client.conn, ssl.SSLSocket):
+                        # Records are encrypted in user space, so no sendfile
+                        chunk = os.pread(pending.file.fileno(), min(pending.count, TLS_CHUNK_SIZE), pending.offset)
+                        sent = client.conn.send(chunk) if chunk else 0
+                        full = sent < len(chunk)
+                    else:
+                        sent = os.sendfile(client.conn.fileno(), pending.file.fileno(), pending.offset, pending.count)
+                        full = sent < pending.count
+                    pending.offset += sent
+                    pending.count -= sent
+                    if pending.count and sent:
+                        if full:
+                            return     # Socket buffer full, wait until writable again
+                        continue
+                    client.pending = b""
+                else:
+                    sent = client.conn.send(pending)
+                    client.pending = pending[sent:]
+                    if client.pending:
+                        return         # Socket buffer full, wait until writable again
+        except WOULD_BLOCK:
+            return
+        except Exception as e:
+            print("  Request Failed:- {!r}".format(e))
+            self.close(client)
+
+    def close(self, client):
+        if client.parts is not None:
+            client.parts.close()       # Closes any file the response still holds open
+        self.selector.unregister(client.conn)
+        client.conn.close()
+        self.connections -= 1
+        self.resume_accepting()
+        print("Connection Closed\n")
+
+
+class Dispatcher:
+    """Accept connections and keep the ones between requests in a selector,
+    handing a connection to a worker only when it has a request to read, so
+    that clients holding keep-alive connections open, or stalling their TLS
+    handshake, do not hold the workers"""
+
+    def __init__(self, server, submit, max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT,
+                 context=None):
+        self.server = server
+        self.submit = submit           # submit(fn, *args) runs fn on a worker
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.context = context
+        self.selector = selectors.DefaultSelector()
+        self.done = Queue()            # (client, keep) of the turns workers have finished
+        self.wakeup, self.waker = socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        self.connections = 0
+        self.accepting = False
+
+    def run(self):
+        self.server.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ, self.wakeup)
+        self.resume_accepting()
+        swept = time.monotonic()
+        while True:
+            for key, _ in self.selector.select(1):
+                if key.data is None:
+                    self.accept()
+                elif key.data is self.wakeup:
+                    self.collect()
+                elif key.data.handshaking:
+                    self.handshake(key.data)
+                else:
+                    self.dispatch(key.data)
+            now = time.monotonic()
+            if now - swept >= 1:
+                self.close_idle(now)
+                swept = now
+
+    def resume_accepting(self):
+        if not self.accepting:
+            self.selector.register(self.server, selectors.EVENT_READ)
+            self.accepting = True
+
+    def pause_accepting(self):
+        if self.accepting:
+            self.selector.unregister(self.server)
+            self.accepting = False
+
+    def accept(self):
+        while self.connections < self.max_connections:
+            try:
+                conn, addr = self.server.accept()
+            except BlockingIOError:
+                return                 # Another process may have taken it
+            print("Accepted Connection:- {}".format(addr[0]+":"+str(addr[1])))
+            if self.context is not None:
+                # Handshake here without blocking, as EventLoopServer does, and
+                # give the connection its blocking timeout once that is done
+                conn.setblocking(False)
+                conn = self.context.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
+            else:
+                conn.settimeout(self.idle_timeout)
+            self.selector.register(conn, selectors.EVENT_READ, Connection(conn, addr))
+            self.connections += 1
+        self.pause_accepting()     # Leave the rest in the backlog until a connection closes
+
+    def handshake(self, client):
+        """Take the TLS handshake one step further without blocking"""
+        try:
+            client.conn.do_handshake()
+        except ssl.SSLWantReadError:
+            self.selector.modify(client.conn, selectors.EVENT_READ, client)
+            return
+        except ssl.SSLWantWriteError:
+            self.selector.modify(client.conn, selectors.EVENT_WRITE, client)
+            return
+        except (ssl.SSLError, OSError) as e:
+            print("  Handshake Failed:- {!r}".format(e))
+            self.selector.unregister(client.conn)
+            self.close(client)
+            return
+        print(tls_summary(client.conn))
+        client.handshaking = False
+        client.last_active = time.monotonic()
+        client.conn.settimeout(self.idle_timeout)
+        if client.conn.pending():
+            self.dispatch(client)      # The request came in with the handshake
+        else:
+            self.selector.modify(client.conn, selectors.EVENT_READ, client)
+
+    def dispatch(self, client):
+        self.selector.unregister(client.conn)
+        self.submit(self.serve, client)
+
+    def serve(self, client):
+        """One turn on a worker: the requests the client has sent so far"""
+        keep = serve_requests(client.conn, client.addr, client.reader)
+        client.last_active = time.monotonic()
+        self.done.put((client, keep))
+        try:
+            self.waker.send(b"\0")
+        except BlockingIOError:
+            pass                       # The dispatcher has wakeups enough to come
+
+    def collect(self):
+        """Take back the connections workers are done with"""
+        try:
+            while self.wakeup.recv(RECV_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                client, keep = self.done.get_nowait()
+            except Empty:
+                return
+            if keep:
+                self.selector.register(client.conn, selectors.EVENT_READ, client)
             else:
-                print("  Responding")
-
-                print("    Creating Header")
-                now = datetime.now()
-
-                header = "HTTP/1.1 200 OK\nContent-Length: 148545\nContent-Type: text/plain; charset=utf-8"
-                header += "Date: " + now.strftime("%a %b %d %H:%M:%S %Y") + "\n"
-                header += "Last-Modified: Wed Aug 29 11:00:00 2018\n"
-                header += "Server: CS430-TCONZ\n"
-
-                print("    Transmitting Header")
-                conn.send(header.encode())
-
-                # Transmit File
-                print("    Transmitting File")
-                with open("alice30.txt","rb") as f:
-                    data = f.read(2048)
-                    while data:
-                        conn.send(data)
-                        data = f.read(2048)
-                print("    Transmission Complete")
-
-        print("  Closing Connection")
-        conn.close()
+                self.close(client)
+
+    def close_idle(self, now):
+        """Close connections that have waited too long for their next request"""
+        for key in list(self.selector.get_map().values()):
+            client = key.data
+            if isinstance(client, Connection) and now - client.last_active > self.idle_timeout:
+                print("  Idle Timeout")
+                self.selector.unregister(client.conn)
+                self.close(client)
+
+    def close(self, client):
+        client.conn.close()
+        self.connections -= 1
+        self.resume_accepting()
         print("Connection Closed\n")
 
+
+def run_threads(server, workers=WORKERS, max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT,
+                context=None):
+    """Accept and wait for requests on the main thread, and serve them from a thread pool"""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        Dispatcher(server, pool.submit, max_connections, idle_timeout, context).run()
+
+def run_prefork(server, workers=WORKERS, max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT,
+                context=None):
+    """Fork workers that accept from the shared listening socket; a TLS context
+    made before the fork gives them all the same session ticket keys"""
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            ACCESS_LOG.start()         # Threads do not survive the fork
+            INDEX.start()
+            CACHE.start()
+            try:
+                # An event loop per process, so one slow client holds up nobody else
+                EventLoopServer(server, max_connections, idle_timeout, context).run()
+            finally:
+                ACCESS_LOG.close()
+                os._exit(0)
+        pids.append(pid)
+
+    def shutdown(signum, frame):
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+def main(*argv):
+    """Main loop"""
+    parser = argparse.ArgumentParser(prog="webserver.py", description="Python Web server")
+    parser.add_argument("--mode", choices=MODES, default=MODES[0],
+                        help="event loop, thread pool or pre-forked processes")
+    parser.add_argument("--backlog", type=int, default=BACKLOG, help="listen() backlog")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="most connections served at once (per process in prefork mode)")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="threads or processes")
+    parser.add_argument("--tls", action="store_true", help="speak HTTPS instead of plain HTTP")
+    parser.add_argument("--cert", default=CERTFILE,
+                        help="certificate chain for --tls, a self-signed one is made if missing")
+    parser.add_argument("--key", default=KEYFILE, help="private key for --tls")
+    parser.add_argument("--docroot", default=DOCROOT, help="directory the files are served from")
+    parser.add_argument("--index-refresh", type=float, default=INDEX_REFRESH_SEC,
+                        help="seconds between rescans of the document root, 0 to scan only at startup")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE,
+                        help="bytes of file contents to hold in memory")
+    parser.add_argument("--cache-file-size", type=int, default=CACHE_FILE_SIZE,
+                        help="largest file to hold in memory, bigger ones are sent from disk")
+    parser.add_argument("--log", default=LOGFILE, help="access log file")
+    parser.add_argument("--log-format", default=LOG_FORMAT,
+                        help="access log line, from {time} {method} {path} {version} {ip} {agent}")
+    parser.add_argument("--log-max-bytes", type=int, default=LOG_MAX_BYTES,
+                        help="size at which the access log is rotated, 0 to never rotate")
+    parser.add_argument("--log-backups", type=int, default=LOG_BACKUPS, help="rotated access logs to keep")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds a kept-alive connection may wait for its next request")
+    args = parser.parse_args(argv[0][1:] if argv else [])
+
+    global INDEX, CACHE, ACCESS_LOG
+    INDEX = DocumentIndex(args.docroot, args.index_refresh, private=(args.cert, args.key, args.log))
+    INDEX.refresh()
+    CACHE = ContentCache(args.cache_size, args.cache_file_size)
+    ACCESS_LOG = AccessLog(args.log, args.log_format, args.log_max_bytes, args.log_backups)
+
+    context = None
+    if args.tls:
+        if not os.path.exists(args.cert):
+            print("Making a self-signed certificate:- {}".format(args.cert))
+            make_certificate(args.cert, args.key)
+        context = make_tls_context(args.cert, args.key)
+
+    server = make_server(args.backlog)
+    print("Listening on {}:{} ({} mode{})".format(ADDRESS, PORT, args.mode, ", TLS" if args.tls else ""))
+
+    with server:
+        if args.mode == "prefork":
+            run_prefork(server, args.workers, args.max_connections, args.idle_timeout, context)
+            return
+        ACCESS_LOG.start()
+        INDEX.start()
+        CACHE.start()
+        try:
+            if args.mode == "select":
+                EventLoopServer(server, args.max_connections, args.idle_timeout, context).run()
+            else:
+                run_threads(server, args.workers, args.max_connections, args.idle_timeout, context)
+        finally:
+            CACHE.stop()
+            INDEX.stop()
+            ACCESS_LOG.close()
+
 if __name__ == "__main__":
-    main()
+    main(sys.argv)